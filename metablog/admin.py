@@ -6,7 +6,7 @@ from wysihtml5.admin import AdminWysihtml5TextFieldMixin
 from wysihtml5.fields import Wysihtml5TextField
 from wysihtml5.widgets import Wysihtml5TextareaWidget
 
-from models import Tag, Post, Category, Slide, SlideShow, SlideShowSlide, Link
+from models import Tag, Post, Category, Slide, SlideShow, SlideShowSlide, Link, Ping
 #from sorl.thumbnail.admin import AdminImageMixin
 
 ################################################################################
@@ -89,6 +89,18 @@ class LinkAdmin(admin.ModelAdmin):
 
 admin.site.register(Link, LinkAdmin)
 
+
+################################################################################
+
+class PingAdmin(admin.ModelAdmin):
+    list_display = (
+        'url', 'endpoint', 'post', 'status', 'due_date', 'sent_date', 'attempts'
+    )
+    list_filter = ('status', 'kind',)
+    ordering = ('-create_date',)
+
+admin.site.register(Ping, PingAdmin)
+
 #class PhotoAdmin(AdminImageMixin, admin.ModelAdmin):
 #    pass
 
@@ -0,0 +1,526 @@
+"""@package docstring
+Precomputed post archive used by the Metablog sidebar.
+
+One archive tree is cached for the public status set and one for the admin
+status set.  Post signal handlers update the cached trees in place, so views
+read a ready-made tree instead of walking every post on each request.
+
+Each tree is stored under a generation counter, its version.  A handler
+takes the next version with an atomic increment and stores its updated tree
+only if no other handler took a version in between; otherwise the tree is
+left for the next reader to build from the database, so concurrent saves
+never overwrite each other's changes.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.backends.util import typecast_timestamp
+from django.db.models import Count, Max, Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from models import Post
+from caching import GENERATION_KEY, get_generation, bump_generation
+from urlbuilder import article_url, archive_year_url, archive_month_url, archive_month_articles_url
+
+from datetime import date, datetime, timedelta
+
+
+ARCHIVE_CACHE_KEY = 'metablog:archive:%s:%s:%d'
+
+# Archive modes (setting CK_METABLOG_ARCHIVE_MODE.)
+#   'full'      - every article is listed under its month.
+#   'summary'   - months carry counts only; articles are fetched per month.
+ARCHIVE_FULL = 'full'
+ARCHIVE_SUMMARY = 'summary'
+
+
+def archive_mode():
+    return getattr(settings, 'CK_METABLOG_ARCHIVE_MODE', ARCHIVE_FULL)
+
+
+def create_post_archive(posts):
+    """
+    Order posts by post date from latest to earliest, returning
+    the posts in hierachicial JSON form:
+    {
+        archives: [
+            {
+                key: "<year>"
+                year: <year>,
+                uri: "<year>/",
+                count: <post count>,
+                archives: [
+                    {
+                        key: "<month>",
+                        month: <month number>,
+                        uri: "<year>/<month>"
+                        count: <post count>,
+                        >
+                        articles: [
+                            {
+                                title: "<title>",
+                                uri: "<year>/",
+                                date: <datetime>
+                                id: <post id, guaranteed to the unique per article>
+                            },
+                            ...
+                        ],
+                    },
+                    ...
+                ],
+            },
+            ...
+        ]
+    }
+    """
+    posts = posts.all().values('id', 'title', 'slug', 'post_date', 'status')
+
+    archive_stack = []
+    archive_stack.append([])        # archive list (top-level contains years)
+
+    year = -1
+    year_count = 0
+    month = -1
+    month_count = 0
+
+    for post in posts:
+        post_date = Post.archive_date(post['post_date'])
+
+        if year != post_date.year:
+            if year != -1:
+                # fixup stack - top = articles,
+                # fixup stack - top-1 = months
+                articles = archive_stack.pop()
+                months = archive_stack.pop()
+                months[-1]['articles'] = articles
+                months[-1]['count'] = month_count
+                year_count += month_count
+                month_count = 0
+                archive_stack[-1][-1]['archives'] = months
+                archive_stack[-1][-1]['count'] = year_count
+                year_count = 0
+
+            year = post_date.year
+            archive_stack[-1].append(year_node(post_date))  # append year to years array (stack top)
+
+            month = -1
+            archive_stack.append([])    # append new months array to stack top.
+
+        if month != post_date.month:
+            if month != -1:
+                # fixup stack - top = articles
+                articles = archive_stack.pop()
+                archive_stack[-1][-1]['articles'] = articles
+                archive_stack[-1][-1]['count'] = month_count
+                year_count += month_count
+                month_count = 0
+
+            month = post_date.month
+            archive_stack[-1].append(month_node(post_date))  # append month to months array (stack top)
+
+            archive_stack.append([])    # append new articles array to stack top.
+
+        # add article link
+        archive_stack[-1].append(article_node(post))
+        month_count += 1
+
+    # final fixup.
+    if len(archive_stack) == 3:
+        # fixup stack - top = articles,
+        # fixup stack - top-1 = months
+        articles = archive_stack.pop()
+        months = archive_stack.pop()
+        months[-1]['articles'] = articles
+        months[-1]['count'] = month_count
+        year_count += month_count
+        archive_stack[-1][-1]['archives'] = months
+        archive_stack[-1][-1]['count'] = year_count
+    else:
+        return None
+
+    return {
+        'archives': archive_stack.pop()
+    }
+
+
+def summarize_post_archive(posts):
+    """
+    Same layout as create_post_archive(), but months hold no articles.  The
+    year and month counts come from GROUP BY queries (see
+    archive_month_counts), so the result grows with the number of months
+    instead of the number of posts.  A month's articles are listed by
+    month_articles().
+    """
+    archives = []
+    for (year, month), count in sorted(archive_month_counts(posts).items(), reverse=True):
+        month_start = date(year, month, 1)
+        if not archives or archives[-1]['year'] != year:
+            archives.append(year_node(month_start))
+        node = month_node(month_start, with_articles=False)
+        node['count'] = count
+        archives[-1]['archives'].append(node)
+        archives[-1]['count'] += count
+
+    if not archives:
+        return None
+
+    return {
+        'archives': archives
+    }
+
+
+def _truncated_counts(posts, kind):
+    """
+    (start of period, post count) for each 'month' or 'day' of post_date
+    holding posts, as the database truncates it.
+    """
+    qn = connection.ops.quote_name
+    field_name = '%s.%s' % (qn(Post._meta.db_table), qn('post_date'))
+    rows = posts.order_by().extra(
+        select={'period': connection.ops.date_trunc_sql(kind, field_name)}
+    ).values(
+        'period'
+    ).annotate(
+        count=Count('id')
+    )
+    for row in rows:
+        period = row['period']
+        if isinstance(period, basestring):
+            period = typecast_timestamp(period)
+        yield period, row['count']
+
+
+def archive_month_counts(posts):
+    """
+    Returns {(year, month): post count}, with months in the site timezone
+    as Post.archive_date gives them, so the counts agree with the months
+    ArchiveTree.insert and remove use.
+
+    Without USE_TZ dates are stored in the site timezone and are grouped by
+    month.  With it they are stored in UTC, and a UTC month is not a local
+    one, so posts are grouped by UTC day instead: a timezone offset is under
+    a day, so every day but the first and last of a month lies in a single
+    local month.  The posts of those edge days are dated one by one.
+    """
+    counts = {}
+
+    def add(year, month, count):
+        counts[(year, month)] = counts.get((year, month), 0) + count
+
+    if not settings.USE_TZ:
+        for month_start, count in _truncated_counts(posts, 'month'):
+            add(month_start.year, month_start.month, count)
+        return counts
+
+    edges = Q()
+    has_edges = False
+    for day, count in _truncated_counts(posts, 'day'):
+        if day.day == 1 or (day + timedelta(days=1)).month != day.month:
+            start = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+            edges |= Q(post_date__gte=start, post_date__lt=start + timedelta(days=1))
+            has_edges = True
+        else:
+            add(day.year, day.month, count)
+
+    if has_edges:
+        for post_date in posts.order_by().filter(edges).values_list('post_date', flat=True):
+            post_date = Post.archive_date(post_date)
+            add(post_date.year, post_date.month, 1)
+    return counts
+
+
+def month_articles(statuses, year, month):
+    """
+    Article nodes for a single archive month, latest first.
+    """
+    posts = Post.query(statuses, year=year, month=month)
+    return [article_node(post) for post in posts.values('id', 'title', 'slug', 'post_date')]
+
+
+def year_node(post_date):
+    return {
+        'key': str(post_date.year),
+        'year': post_date.year,
+        'uri': archive_year_url(post_date.year),
+        'count': 0,
+        'archives': [],
+    }
+
+
+def month_node(post_date, with_articles=True):
+    node = {
+        'key': post_date.strftime("%B"),
+        'month': post_date.month,
+        'uri': archive_month_url(post_date.year, post_date.month),
+        'count': 0,
+        'articles': [],
+    }
+    if not with_articles:
+        node['articles'] = None
+        node['articles_uri'] = archive_month_articles_url(post_date.year, post_date.month)
+    return node
+
+
+def article_node(post):
+    """
+    Archive entry for a post, given either a Post or a values() dictionary.
+    """
+    if isinstance(post, Post):
+        post = {'id': post.pk, 'title': post.title, 'slug': post.slug,
+                'post_date': post.post_date}
+    return {
+        'title': post['title'],
+        'uri': article_url(post['slug']),
+        'date': post['post_date'],
+        'id': post['id']
+    }
+
+
+def _find_or_insert(nodes, field, value, create):
+    """
+    Returns the node whose 'field' equals value from a list ordered newest
+    first, inserting the node returned by create() in order if none exists.
+    """
+    for index, node in enumerate(nodes):
+        if node[field] == value:
+            return node
+        if node[field] < value:
+            break
+    else:
+        index = len(nodes)
+
+    node = create()
+    nodes.insert(index, node)
+    return node
+
+
+class ArchiveTree(object):
+    """
+    Year -> month -> article tree for one set of post statuses.
+
+    Nodes use the layout returned by create_post_archive(), so templates treat
+    a cached tree and a freshly built archive the same way.  Summary trees
+    (see summarize_post_archive) only keep year and month counts.
+
+    'version' is the generation the tree is cached under (see
+    get_archive_tree); it changes whenever the tree does.
+    'last_modified' is the newest modified_date of the posts in the tree, or
+    the time a post last left it.
+    """
+    def __init__(self, statuses, archives=None, with_articles=True, last_modified=None):
+        self.statuses = frozenset(statuses)
+        self.archives = archives or []
+        self.with_articles = with_articles
+        self.version = None
+        self.last_modified = last_modified
+
+    @classmethod
+    def build(cls, statuses, with_articles=True):
+        posts = Post.query(statuses=statuses)
+        if with_articles:
+            archive = create_post_archive(posts)
+        else:
+            archive = summarize_post_archive(posts)
+        last_modified = posts.aggregate(newest=Max('modified_date'))['newest']
+        if archive is None:
+            return cls(statuses, with_articles=with_articles, last_modified=last_modified)
+        return cls(statuses, archive['archives'], with_articles, last_modified)
+
+    def as_dict(self):
+        if not self.archives:
+            return None
+        return {'archives': self.archives}
+
+    def expanded(self, year, month):
+        """
+        Returns as_dict() with the articles of one month filled in.  Nodes
+        along the path are copied so the cached tree is left untouched.
+        """
+        if self.with_articles:
+            return self.as_dict()
+
+        years = []
+        for year_archive in self.archives:
+            if year_archive['year'] == year:
+                year_archive = dict(year_archive)
+                months = []
+                for month_archive in year_archive['archives']:
+                    if month_archive['month'] == month:
+                        month_archive = dict(month_archive)
+                        month_archive['articles'] = month_articles(self.statuses, year, month)
+                    months.append(month_archive)
+                year_archive['archives'] = months
+            years.append(year_archive)
+
+        if not years:
+            return None
+        return {'archives': years}
+
+    def insert(self, article):
+        """
+        Adds an article node (see article_node) in date order.  Summary trees
+        only count it.
+        """
+        post_date = Post.archive_date(article['date'])
+        year = _find_or_insert(self.archives, 'year', post_date.year,
+                               lambda: year_node(post_date))
+        month = _find_or_insert(year['archives'], 'month', post_date.month,
+                                lambda: month_node(post_date, self.with_articles))
+
+        if self.with_articles:
+            articles = month['articles']
+            order = (article['date'], article['id'])
+            index = 0
+            while index < len(articles) and (articles[index]['date'], articles[index]['id']) > order:
+                index += 1
+            articles.insert(index, article)
+
+        month['count'] += 1
+        year['count'] += 1
+
+    def remove(self, post_id, post_date=None):
+        """
+        Removes the article for post_id, returning its node or None.  The
+        month for post_date is searched first, then the whole tree.
+        """
+        if post_date is not None:
+            post_date = Post.archive_date(post_date)
+        for year in self.archives:
+            if post_date is not None and year['year'] != post_date.year:
+                continue
+            for month in year['archives']:
+                if post_date is not None and month['month'] != post_date.month:
+                    continue
+                for index, article in enumerate(month['articles']):
+                    if article['id'] == post_id:
+                        del month['articles'][index]
+                        self._discount(year, month)
+                        return article
+
+        if post_date is not None:
+            return self.remove(post_id)
+        return None
+
+    def update(self, post_id, old_post_date, article, was_listed=True, modified_date=None):
+        """
+        Moves, inserts or removes a single article.  'article' is None if the
+        post no longer belongs in this tree, 'was_listed' is False if it did
+        not belong before.  Returns True if the tree changed.
+        """
+        removed = None
+        if self.with_articles:
+            if was_listed:
+                removed = self.remove(post_id, old_post_date)
+            changed = removed != article
+        else:
+            if was_listed:
+                removed = self._uncount(old_post_date)
+            changed = removed != _month_of(article)
+
+        if article is not None:
+            self.insert(article)
+        if changed:
+            modified_date = modified_date or timezone.now()
+            if self.last_modified is None or modified_date > self.last_modified:
+                self.last_modified = modified_date
+        return changed
+
+    def _uncount(self, post_date):
+        post_date = Post.archive_date(post_date)
+        for year in self.archives:
+            if year['year'] != post_date.year:
+                continue
+            for month in year['archives']:
+                if month['month'] == post_date.month:
+                    self._discount(year, month)
+                    return (post_date.year, post_date.month)
+        return None
+
+    def _discount(self, year, month):
+        month['count'] -= 1
+        year['count'] -= 1
+        if month['count'] == 0:
+            year['archives'].remove(month)
+        if year['count'] == 0:
+            self.archives.remove(year)
+
+
+def _month_of(article):
+    if article is None:
+        return None
+    post_date = Post.archive_date(article['date'])
+    return (post_date.year, post_date.month)
+
+
+def _generation_name(is_admin):
+    return 'archive:%s:%s' % (archive_mode(), 'admin' if is_admin else 'public')
+
+
+def _cache_key(is_admin, version):
+    return ARCHIVE_CACHE_KEY % (archive_mode(), 'admin' if is_admin else 'public', version)
+
+
+def archive_version_key(is_admin):
+    """
+    The cache key holding the current tree version, for readers that only
+    need to know whether the tree changed.
+    """
+    return GENERATION_KEY % _generation_name(is_admin)
+
+
+def _cache_timeout():
+    return getattr(settings, 'CK_METABLOG_ARCHIVE_CACHE_TIMEOUT', 60 * 60 * 24)
+
+
+def get_archive_tree(is_admin):
+    """
+    Returns the ArchiveTree for public or admin visitors, building it once if
+    the cache does not hold one.
+    """
+    version = get_generation(_generation_name(is_admin))
+    key = _cache_key(is_admin, version)
+    tree = cache.get(key)
+    if tree is None:
+        tree = ArchiveTree.build(Post.visible_statuses(is_admin),
+                                 archive_mode() != ARCHIVE_SUMMARY)
+        tree.version = version
+        cache.add(key, tree, _cache_timeout())
+    return tree
+
+
+def _update_cached_trees(post, old_status, old_post_date, created=False, deleted=False):
+    for is_admin in (False, True):
+        name = _generation_name(is_admin)
+        version = get_generation(name)
+        tree = cache.get(_cache_key(is_admin, version))
+        if tree is None:
+            # a reader may be building this version from rows read before the
+            # change; move on so the tree is built again.
+            bump_generation(name)
+            continue
+        article = None
+        if not deleted and post.status in tree.statuses:
+            article = article_node(post)
+        was_listed = not created and old_status in tree.statuses
+        modified_date = None if deleted else post.modified_date
+        if tree.update(post.pk, old_post_date, article, was_listed, modified_date):
+            tree.version = bump_generation(name)
+            if tree.version == version + 1:
+                cache.set(_cache_key(is_admin, tree.version), tree, _cache_timeout())
+
+
+@receiver(post_save, sender=Post, dispatch_uid='metablog.archive_tree.post_saved')
+def post_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    _update_cached_trees(instance, instance._original_status,
+                         instance._original_post_date, created=created)
+
+
+@receiver(post_delete, sender=Post, dispatch_uid='metablog.archive_tree.post_deleted')
+def post_deleted(sender, instance, **kwargs):
+    _update_cached_trees(instance, instance._original_status,
+                         instance._original_post_date, deleted=True)
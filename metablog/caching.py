@@ -0,0 +1,131 @@
+"""@package docstring
+Generation-keyed caching for Metablog.
+
+Cached values are stored under a key that includes a generation counter.
+Invalidating bumps the counter, so stale entries are never read again and
+simply expire from the cache.
+"""
+
+from django.core.cache import cache
+from django.core.signals import request_started, request_finished
+from django.db import transaction
+
+from threading import local
+from time import time
+
+
+GENERATION_KEY = 'metablog:generation:%s'
+GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def _initial_generation():
+    # counters restart from the clock if evicted, so an old generation is
+    # never reused.
+    return int(time() * 1000)
+
+
+def get_generation(name):
+    key = GENERATION_KEY % name
+    generation = cache.get(key)
+    if generation is None:
+        generation = _initial_generation()
+        if not cache.add(key, generation, GENERATION_TIMEOUT):
+            generation = cache.get(key, generation)
+    return generation
+
+
+def get_generations(names):
+    """
+    Returns {generation cache key: generation} for several counters with one
+    cache read.
+    """
+    keys = dict((GENERATION_KEY % name, name) for name in names)
+    generations = cache.get_many(keys.keys())
+    for key, name in keys.items():
+        if key not in generations:
+            generations[key] = get_generation(name)
+    return generations
+
+
+def bump_generation(name):
+    key = GENERATION_KEY % name
+    try:
+        return cache.incr(key)
+    except ValueError:
+        generation = _initial_generation()
+        cache.set(key, generation, GENERATION_TIMEOUT)
+        return generation
+
+
+_pending = local()
+
+
+def bump_generation_on_commit(name):
+    """
+    Bumps a generation now and, inside a managed transaction, once more when
+    the request ends, after the transaction has committed.  A value cached
+    meanwhile from rows read before the commit is then dropped as well.
+    """
+    generation = bump_generation(name)
+    if transaction.is_managed():
+        names = getattr(_pending, 'names', None)
+        if names is None:
+            names = _pending.names = set()
+        names.add(name)
+    return generation
+
+
+def bump_pending_generations(sender=None, **kwargs):
+    names = getattr(_pending, 'names', None)
+    _pending.names = None
+    for name in names or ():
+        bump_generation(name)
+
+
+request_started.connect(bump_pending_generations, dispatch_uid='metablog.caching.request_started')
+request_finished.connect(bump_pending_generations, dispatch_uid='metablog.caching.request_finished')
+
+
+class GenerationCache(object):
+    """
+    A family of cached values sharing one generation counter.
+
+    'hits' and 'misses' count lookups made by this process.
+    """
+    def __init__(self, name, timeout=None):
+        self.name = name
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, key, generation=None):
+        if generation is None:
+            generation = get_generation(self.name)
+        return 'metablog:%s:%s:%d' % (self.name, key, generation)
+
+    def get(self, key, build):
+        """
+        Returns the cached value for key, calling build() to create and
+        store it on a miss.
+        """
+        cache_key = self.key(key)
+        value = cache.get(cache_key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        value = build()
+        cache.set(cache_key, value, self.timeout)
+        return value
+
+    def invalidate(self):
+        bump_generation(self.name)
+
+    def stats(self):
+        return {
+            'name': self.name,
+            'generation': get_generation(self.name),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -0,0 +1,109 @@
+"""@package docstring
+Precompressed encodings of cached response bodies.
+
+A body is compressed once, when it is cached, into gzip and (with the brotli
+package installed) brotli variants.  Requests are then answered with the
+best variant their Accept-Encoding allows, without compressing anything.
+Responses carry Content-Encoding, so GZipMiddleware leaves them alone.
+
+Each variant is a representation of its own: variant_response() gives it an
+ETag naming its coding, and sends Vary: Accept-Encoding on 304s as well.
+"""
+
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_string
+
+from conditional import is_not_modified, not_modified, set_validators
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Content codings, most preferred first.
+ENCODINGS = ('br', 'gzip')
+
+
+def compress_variants(content):
+    """
+    Returns {content coding: compressed bytes} for the codings that make
+    content smaller.
+    """
+    variants = {}
+    gzipped = compress_string(content)
+    if len(gzipped) < len(content):
+        variants['gzip'] = gzipped
+    if brotli is not None:
+        compressed = brotli.compress(content)
+        if len(compressed) < len(content):
+            variants['br'] = compressed
+    return variants
+
+
+def accepted_encodings(accept_encoding):
+    """
+    The content codings of an Accept-Encoding header with a non-zero
+    quality.
+    """
+    accepted = set()
+    for coding in accept_encoding.split(','):
+        parts = coding.strip().split(';')
+        name = parts[0].strip().lower()
+        quality = 1.0
+        for param in parts[1:]:
+            key, _, value = param.strip().partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name and quality > 0.0:
+            accepted.add(name)
+    return accepted
+
+
+def choose_encoding(request, variants):
+    accepted = accepted_encodings(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    for coding in ENCODINGS:
+        if coding in variants and (coding in accepted or '*' in accepted):
+            return coding
+    return None
+
+
+def variant_etag(etag, coding):
+    if etag is None or coding is None:
+        return etag
+    return '%s-%s' % (etag, coding)
+
+
+def encoded_response(request, content, variants, content_type, coding=False):
+    """
+    A response with the variant of content best suited to the request, or
+    with the given coding (None for the identity).
+    """
+    if coding is False:
+        coding = choose_encoding(request, variants)
+    if coding is None:
+        response = HttpResponse(content, content_type=content_type)
+    else:
+        response = HttpResponse(variants[coding], content_type=content_type)
+        response['Content-Encoding'] = coding
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
+
+
+def variant_response(request, content, variants, content_type, etag=None, last_modified=None):
+    """
+    encoded_response() with validators for the chosen variant, or a 304 if
+    the client already holds it.
+    """
+    coding = choose_encoding(request, variants)
+    etag = variant_etag(etag, coding)
+    if is_not_modified(request, etag, last_modified):
+        response = not_modified(etag, last_modified)
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+    response = encoded_response(request, content, variants, content_type, coding)
+    return set_validators(response, etag, last_modified)
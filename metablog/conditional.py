@@ -0,0 +1,50 @@
+"""@package docstring
+Conditional GET helpers for Metablog responses built from cached data.
+
+Views compute an ETag and Last-Modified time from cached state and can answer
+a matching request with 304 before doing any other work.
+"""
+
+from django.http import HttpResponseNotModified
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+
+from calendar import timegm
+
+
+def _timestamp(last_modified):
+    return timegm(last_modified.utctimetuple())
+
+
+def is_not_modified(request, etag=None, last_modified=None):
+    """
+    True if the request's If-None-Match or If-Modified-Since headers show
+    the client already has this version.  If-None-Match wins when present.
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return False
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        if etag is None:
+            return False
+        etags = parse_etags(if_none_match)
+        return etag in etags or '*' in etags
+
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since and last_modified is not None:
+        if_modified_since = parse_http_date_safe(if_modified_since)
+        return if_modified_since is not None and _timestamp(last_modified) <= if_modified_since
+
+    return False
+
+
+def set_validators(response, etag=None, last_modified=None):
+    if etag is not None:
+        response['ETag'] = quote_etag(etag)
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(_timestamp(last_modified))
+    return response
+
+
+def not_modified(etag=None, last_modified=None):
+    return set_validators(HttpResponseNotModified(), etag, last_modified)
@@ -0,0 +1,39 @@
+"""@package docstring
+Text derived from post bodies when a Post is saved.
+"""
+
+from django.conf import settings
+from django.utils.html import strip_tags
+from django.utils.text import Truncator
+
+from math import ceil
+import re
+
+
+re_tag = re.compile(r'<[^>]*>')
+
+
+def plain_text(html):
+    return strip_tags(html)
+
+
+def count_words(html):
+    # a tag separates words: '...four</p><p>five...' holds two
+    return len(re_tag.sub(u' ', html).split())
+
+
+def summarize(html, word_limit):
+    """
+    Returns (excerpt, word count, reading time in minutes) for a post body.
+    The excerpt is the body cut after word_limit words with its HTML tags
+    balanced, as the truncatewords_html filter would render it.
+    """
+    excerpt = Truncator(html).words(word_limit, html=True, truncate=' ...')
+    word_count = count_words(html)
+
+    words_per_minute = getattr(settings, 'CK_METABLOG_WORDS_PER_MINUTE', 200)
+    reading_time = 0
+    if word_count:
+        reading_time = int(ceil(word_count / float(words_per_minute)))
+
+    return excerpt, word_count, reading_time
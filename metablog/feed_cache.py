@@ -0,0 +1,98 @@
+"""@package docstring
+Rendered feed documents, cached per (feed type, category).
+
+Each entry holds the feed bytes and their compressed variants with its ETag
+and Last-Modified time, so a poll is answered from the cache alone, and with
+304 when the reader already has the document.  Every feed shares the 'feeds'
+generation, bumped when a Tag or Category changes, and a category feed also
+has a generation of its own, bumped when one of its posts is published,
+edited or removed; the latest-posts feed is keyed as the category ''.
+"""
+
+from django.conf import settings
+from django.db.models.signals import post_save, pre_delete, m2m_changed
+from django.utils import timezone
+
+from models import Post, Category, Tag
+from caching import GenerationCache, get_generation, bump_generation
+from compression import compress_variants
+
+from hashlib import md5
+
+
+feed_cache = GenerationCache(
+    'feeds', getattr(settings, 'CK_METABLOG_FEED_CACHE_TIMEOUT', 60 * 60 * 24))
+
+ALL_POSTS = ''
+
+
+def category_generation_name(category_slug):
+    return 'feeds:%s' % (category_slug or ALL_POSTS)
+
+
+def feed_entry(response):
+    """
+    The cached form of a rendered feed response.
+    """
+    content = response.content
+    return {
+        'content': content,
+        'variants': compress_variants(content),
+        'content_type': response['Content-Type'],
+        'etag': md5(content).hexdigest(),
+        'last_modified': timezone.now().replace(microsecond=0),
+    }
+
+
+def get_feed(feed_name, scheme, category_slug, build):
+    """
+    Returns the cached entry of a feed, calling build() for the rendered
+    response on a miss.
+    """
+    generation = get_generation(category_generation_name(category_slug))
+    key = '%s:%s:%s:%d' % (feed_name, scheme, category_slug or ALL_POSTS, generation)
+    return feed_cache.get(key, lambda: feed_entry(build()))
+
+
+def invalidate_category_feeds(category_slugs):
+    bump_generation(category_generation_name(ALL_POSTS))
+    for slug in category_slugs:
+        bump_generation(category_generation_name(slug))
+
+
+def post_changed(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    visible = Post.visible_statuses(False)
+    if instance.status in visible or instance._original_status in visible:
+        invalidate_category_feeds(instance.tags.values_list('slug', flat=True))
+
+
+def post_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse:
+        slugs = [instance.slug]
+    elif action == 'pre_clear':
+        slugs = instance.tags.values_list('slug', flat=True)
+    else:
+        slugs = Tag.objects.filter(pk__in=pk_set).values_list('slug', flat=True)
+    invalidate_category_feeds(slugs)
+
+
+def invalidate_feeds(sender, raw=False, **kwargs):
+    if not raw:
+        feed_cache.invalidate()
+
+
+post_save.connect(post_changed, sender=Post, dispatch_uid='metablog.feed_cache.post_saved')
+# before the delete, while the post's tags can still be read
+pre_delete.connect(post_changed, sender=Post, dispatch_uid='metablog.feed_cache.post_deleting')
+m2m_changed.connect(post_tags_changed, sender=Post.tags.through,
+                    dispatch_uid='metablog.feed_cache.post_tags_changed')
+
+for model in (Category, Tag):
+    post_save.connect(invalidate_feeds, sender=model,
+                      dispatch_uid='metablog.feed_cache.saved.%s' % model.__name__)
+    pre_delete.connect(invalidate_feeds, sender=model,
+                       dispatch_uid='metablog.feed_cache.deleted.%s' % model.__name__)
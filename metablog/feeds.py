@@ -1,18 +1,116 @@
-from django.contrib.syndication.views import Feed
+from django.contrib.sites.models import get_current_site
+from django.contrib.syndication.views import Feed, add_domain
 from django.conf import settings
-from django.http import Http404
+from django.core.urlresolvers import reverse
+from django.http import Http404, StreamingHttpResponse
+from django.utils.cache import patch_cache_control
 from django.utils.feedgenerator import Atom1Feed
 from django.utils.feedgenerator import Rss201rev2Feed
+from django.utils.feedgenerator import SyndicationFeed, rfc3339_date
 from django.utils.safestring import mark_safe 
+from django.utils.xmlutils import SimplerXMLGenerator
 
-from models import Post, Category
+from models import Post
+from taxonomy import resolve_slug, all_categories
+from caching import get_generation
+from feed_cache import feed_cache, category_generation_name, get_feed as get_cached_feed
+from conditional import is_not_modified, not_modified, set_validators
+from compression import variant_response
+from websub import hub_url
 
-class ExtendedRSSFeed(Rss201rev2Feed):
+from copy import copy
+from datetime import datetime
+
+import json
+
+# Feed history (RFC 5005) namespace
+FEED_HISTORY_NS = u'http://purl.org/syndication/history/1.0'
+
+
+def archive_page_size():
+    return getattr(settings, 'CK_METABLOG_FEED_ARCHIVE_PAGE_SIZE', 50)
+
+
+def archive_max_age():
+    # archive pages are complete and rarely change; a deleted or hidden post
+    # shifts later pages, which caches pick up when they revalidate.
+    return getattr(settings, 'CK_METABLOG_FEED_ARCHIVE_MAX_AGE', 60 * 60 * 24 * 30)
+
+
+class StreamBuffer(object):
+    """
+    Collects the output of an XML generator between reads.
+    """
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = ''.join(self.parts)
+        self.parts = []
+        return data
+
+
+class FeedHistoryMixin(object):
+    """
+    Adds RFC 5005 archive links ('history_links', a list of (rel, href)),
+    the fh:archive marker ('is_archive') and a WebSub hub link ('hub') to a
+    feed, and writes it as a stream of chunks.
+    """
+    stream_chunk_size = 16384
+
+    def root_attributes(self):
+        attrs = super(FeedHistoryMixin, self).root_attributes()
+        if self.feed.get('is_archive'):
+            attrs[u'xmlns:fh'] = FEED_HISTORY_NS
+        return attrs
+
+    def latest_post_date(self):
+        # streamed items can only be read once, so their date comes with
+        # the feed
+        if self.feed.get('latest_post_date') is not None:
+            return self.feed['latest_post_date']
+        return super(FeedHistoryMixin, self).latest_post_date()
+
+    def add_root_elements(self, handler):
+        super(FeedHistoryMixin, self).add_root_elements(handler)
+        if self.feed.get('hub'):
+            self.add_link(handler, u'hub', self.feed['hub'])
+        for rel, href in self.feed.get('history_links') or ():
+            self.add_link(handler, rel, href)
+        if self.feed.get('is_archive'):
+            handler.addQuickElement(u'fh:archive')
+
+    def stream(self, encoding):
+        """
+        Yields the document in chunks of about stream_chunk_size bytes.
+        """
+        buffer = StreamBuffer()
+        handler = SimplerXMLGenerator(buffer, encoding)
+        self.write_head(handler)
+        for item in self.items:
+            handler.startElement(self.item_element, self.item_attributes(item))
+            self.add_item_elements(handler, item)
+            handler.endElement(self.item_element)
+            if sum(len(part) for part in buffer.parts) >= self.stream_chunk_size:
+                yield buffer.drain()
+        self.write_tail(handler)
+        yield buffer.drain()
+
+
+class ExtendedRSSFeed(FeedHistoryMixin, Rss201rev2Feed):
     """
     RSS Feed with content encoded elements
     Adopted from:
         https://djangosnippets.org/snippets/2202/
     """
+    item_element = u'item'
+
     def root_attributes(self):
         attrs = super(ExtendedRSSFeed, self).root_attributes()
         attrs['xmlns:content'] = 'http://purl.org/rss/1.0/modules/content/'
@@ -22,35 +120,282 @@ class ExtendedRSSFeed(Rss201rev2Feed):
         super(ExtendedRSSFeed, self).add_item_elements(handler, item)
         handler.addQuickElement(u'content:encoded', item['content_encoded'])
 
+    def add_link(self, handler, rel, href):
+        handler.addQuickElement(u'atom:link', None, {u'rel': rel, u'href': href})
+
+    def write_head(self, handler):
+        handler.startDocument()
+        handler.startElement(u'rss', self.rss_attributes())
+        handler.startElement(u'channel', self.root_attributes())
+        self.add_root_elements(handler)
+
+    def write_tail(self, handler):
+        self.endChannelElement(handler)
+        handler.endElement(u'rss')
+
+
+class HistoryAtom1Feed(FeedHistoryMixin, Atom1Feed):
+    item_element = u'entry'
+
+    def add_link(self, handler, rel, href):
+        handler.addQuickElement(u'link', u'', {u'rel': rel, u'href': href})
+
+    def write_head(self, handler):
+        handler.startDocument()
+        handler.startElement(u'feed', self.root_attributes())
+        self.add_root_elements(handler)
+
+    def write_tail(self, handler):
+        handler.endElement(u'feed')
+
+
+class JsonFeedEncoder(json.JSONEncoder):
+    """
+    Writes datetimes as RFC 3339 strings, as JSON Feed requires.
+    """
+    def default(self, obj):
+        if isinstance(obj, datetime):
+            return rfc3339_date(obj)
+
+        return json.JSONEncoder.default(self, obj)
+
+
+class JsonFeed(SyndicationFeed):
+    """
+    JSON Feed 1.1 (https://jsonfeed.org/version/1.1) from the same feed and
+    item data as the XML feeds.  Older posts of a subscription feed or an
+    archive page are reached through next_url, from its 'prev-archive'
+    history link.
+    """
+    mime_type = 'application/feed+json; charset=utf-8'
+    stream_chunk_size = 16384
+
+    def document(self):
+        """
+        The feed object without its items, which stream() writes one by one.
+        """
+        feed = self.feed
+        document = {
+            'version': u'https://jsonfeed.org/version/1.1',
+            'title': feed['title'],
+            'home_page_url': feed['link'],
+            'description': feed['description'],
+        }
+        if feed.get('feed_url'):
+            document['feed_url'] = feed['feed_url']
+        if feed.get('language'):
+            document['language'] = feed['language']
+        for rel, href in feed.get('history_links') or ():
+            if rel == u'prev-archive':
+                document['next_url'] = href
+        if feed.get('hub'):
+            document['hubs'] = [{'type': u'WebSub', 'url': feed['hub']}]
+        return document
+
+    def item_object(self, item):
+        entry = {
+            'id': item['unique_id'] or item['link'],
+            'url': item['link'],
+            'title': item['title'],
+            'summary': item['description'],
+            'content_html': item['content_encoded'],
+        }
+        if item['pubdate'] is not None:
+            entry['date_published'] = item['pubdate']
+        if item.get('updateddate') is not None:
+            entry['date_modified'] = item['updateddate']
+        if item['author_name']:
+            entry['authors'] = [{'name': item['author_name']}]
+        if item['categories']:
+            entry['tags'] = list(item['categories'])
+        return entry
+
+    def stream(self, encoding):
+        """
+        Yields the document in chunks of about stream_chunk_size bytes.
+        """
+        encoder = JsonFeedEncoder()
+        parts = [encoder.encode(self.document())[:-1], u', "items": [']
+        size = 0
+        for index, item in enumerate(self.items):
+            part = encoder.encode(self.item_object(item))
+            parts.append(part if index == 0 else u', ' + part)
+            size += len(part)
+            if size >= self.stream_chunk_size:
+                yield u''.join(parts).encode(encoding)
+                parts = []
+                size = 0
+        parts.append(u']}')
+        yield u''.join(parts).encode(encoding)
+
+    def write(self, outfile, encoding):
+        for chunk in self.stream(encoding):
+            outfile.write(chunk)
+
+
+class FeedPage(object):
+    """
+    What a feed document shows: the posts of a category (or of the whole
+    blog when category is None), either the latest ones or an archive page.
+
+    Archive pages hold archive_page_size() posts each, oldest first, so a
+    complete page keeps its posts as newer ones arrive.  Only complete
+    pages are archived; the subscription feed carries the posts after the
+    last of them, and never fewer than the latest 10.
+    """
+    def __init__(self, request, category, page=None):
+        self.category = category
+        self.page = page
+        self.chunk = None
+        self.page_size = archive_page_size()
+        self.domain = get_current_site(request).domain
+        self.secure = request.is_secure()
+
+        self.posts = Post.query(Post.visible_statuses(False), self.tags(), listing=True)
+        self.post_count = self.posts.count()
+        self.archived_pages = self.post_count // self.page_size
+        if page is not None and not 1 <= page <= self.archived_pages:
+            raise Http404
+
+    def tags(self):
+        if self.category is None:
+            return None
+        return [self.category.tag]
+
+    def items(self):
+        if self.page is None:
+            latest = self.post_count - self.archived_pages * self.page_size
+            return self.posts[:max(latest, 10)]
+        start = (self.page - 1) * self.page_size
+        stop = start + self.page_size
+        if self.chunk is not None:
+            start, stop = start + self.chunk[0], min(start + self.chunk[1], stop)
+        return self.posts.order_by('post_date', 'id')[start:stop]
+
+    def chunk_of(self, start, stop):
+        """
+        A copy of this archive page that shows its posts [start, stop) only.
+        """
+        page = copy(self)
+        page.chunk = (start, stop)
+        return page
+
+    def latest_post_date(self):
+        """
+        The post_date of the archive page's newest, and last, post.
+        """
+        last = self.page * self.page_size - 1
+        return self.posts.order_by('post_date', 'id').values_list('post_date', flat=True)[last]
+
+    def url(self, feed_name, page=None):
+        kwargs = {}
+        if self.category is not None:
+            kwargs['category_slug'] = self.category.tag.slug
+        name = '%s-%slatest' % (feed_name, 'category-' if self.category is not None else '')
+        if page is not None:
+            kwargs['page'] = page
+            name = '%s-%sarchive' % (feed_name, 'category-' if self.category is not None else '')
+        return add_domain(self.domain, reverse(name, kwargs=kwargs), self.secure)
+
+    def history_links(self, feed_name):
+        links = []
+        if self.page is None:
+            if self.archived_pages:
+                links.append((u'prev-archive', self.url(feed_name, self.archived_pages)))
+            return links
+
+        links.append((u'current', self.url(feed_name)))
+        if self.page > 1:
+            links.append((u'prev-archive', self.url(feed_name, self.page - 1)))
+        if self.page < self.archived_pages:
+            links.append((u'next-archive', self.url(feed_name, self.page + 1)))
+        return links
+
 
 class PostFeed(Feed):
     feed_type = ExtendedRSSFeed
+    feed_name = 'rss'
 
-    def get_object(self, request, category_slug):
-        if category_slug is None:
-            return None
-        categories = Category.objects.all()
-        for category in categories:
-            if category.tag.slug == category_slug:
-                return category
+    # posts read and built into feed items at a time on archive pages
+    archive_chunk_size = 10
+
+    def __call__(self, request, *args, **kwargs):
+        """
+        Serves archive pages as streams, and the subscription feed from
+        feed_cache, rendering it only after a change.
+        """
+        if kwargs.get('page') is not None:
+            return self.archive_page(request, kwargs['category_slug'], int(kwargs['page']))
+
+        scheme = 'https' if request.is_secure() else 'http'
+        entry = get_cached_feed(self.feed_name, scheme, kwargs.get('category_slug'),
+                                lambda: super(PostFeed, self).__call__(request, *args, **kwargs))
+
+        return variant_response(request, entry['content'], entry['variants'],
+                                entry['content_type'], entry['etag'], entry['last_modified'])
 
-        raise Http404
+    def archive_page(self, request, category_slug, page):
+        # The ETag follows the feed generations, which change with any post,
+        # tag or category the page could show, so a conditional GET is
+        # answered before the posts are counted.  No Last-Modified: a page
+        # that shifts to older posts can keep its newest modified_date.
+        etag = '%s-%s-%d-%d-%d-%d' % (self.feed_name, category_slug or '', archive_page_size(),
+                                      page, get_generation(feed_cache.name),
+                                      get_generation(category_generation_name(category_slug)))
+        if is_not_modified(request, etag):
+            response = not_modified(etag)
+        else:
+            obj = self.get_object(request, category_slug, page)
+            feedgen = self.get_feed(obj, request)
+            response = StreamingHttpResponse(feedgen.stream('utf-8'),
+                                             content_type=feedgen.mime_type)
+            set_validators(response, etag)
+
+        patch_cache_control(response, public=True, max_age=archive_max_age())
+        return response
+
+    def get_feed(self, obj, request):
+        """
+        On an archive page the items are built archive_chunk_size posts at a
+        time while the document is written, instead of all up front.
+        """
+        if obj.page is None or obj.chunk is not None:
+            return super(PostFeed, self).get_feed(obj, request)
+
+        feedgen = super(PostFeed, self).get_feed(obj.chunk_of(0, 0), request)
+        feedgen.items = self.archive_items(obj, request)
+        feedgen.feed['latest_post_date'] = obj.latest_post_date()
+        return feedgen
+
+    def archive_items(self, obj, request):
+        for start in range(0, obj.page_size, self.archive_chunk_size):
+            chunk = obj.chunk_of(start, start + self.archive_chunk_size)
+            for item in super(PostFeed, self).get_feed(chunk, request).items:
+                yield item
+
+    def get_object(self, request, category_slug, page=None):
+        category = None
+        if category_slug is not None:
+            category, tag = resolve_slug(category_slug)
+            if category is None:
+                raise Http404
+        return FeedPage(request, category, page)
 
     def title(self, obj):
-        if obj == None:
+        if obj.category == None:
             return settings.CK_SITE_TITLE
-        return "%s - %s" % (settings.CK_SITE_TITLE, obj.long_name)
+        return "%s - %s" % (settings.CK_SITE_TITLE, obj.category.long_name)
 
     def description(self, obj):
-        if obj == None:
+        if obj.category == None:
             return "Articles related to gaming and software development."
-        return "Articles related to %s." % obj.long_name
+        return "Articles related to %s." % obj.category.long_name
 
     def categories(self, obj):
-        if obj == None:
-            categories = Category.objects.all()
+        if obj.category == None:
+            categories = all_categories()
         else:
-            categories = [obj]
+            categories = [obj.category]
 
         cat_strs = []
         for category in categories:
@@ -59,14 +404,19 @@ class PostFeed(Feed):
         return cat_strs
 
     def link(self, obj):
-        if obj == None:
+        if obj.category == None:
             return '/'
-        return obj.get_absolute_url()
+        return obj.category.get_absolute_url()
+
+    def feed_extra_kwargs(self, obj):
+        return {
+            'history_links': obj.history_links(self.feed_name),
+            'is_archive': obj.page is not None,
+            'hub': hub_url(),
+        }
 
     def items(self, obj):
-        if obj == None:
-            return Post.objects.filter(status__gte=Post.PUBLISHED).order_by("-post_date")[:10]
-        return Post.objects.filter(tags__in=[obj.tag]).exclude(status__lte=Post.DRAFT).order_by("-post_date")[:10]
+        return obj.items()
 
     title_template = 'feeds/post_item_title.html'
     description_template = 'feeds/post_item_description.html'
@@ -86,7 +436,13 @@ class PostFeed(Feed):
 
 
 class AtomPostFeed(PostFeed):
-    feed_type = Atom1Feed
+    feed_type = HistoryAtom1Feed
+    feed_name = 'atom'
 
     def subtitle(self, obj):
         return self.description(obj)
+
+
+class JsonPostFeed(PostFeed):
+    feed_type = JsonFeed
+    feed_name = 'json'
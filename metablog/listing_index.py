@@ -0,0 +1,70 @@
+"""@package docstring
+Keeps PostTagIndex in sync with Post and Post.tags.
+
+Rows follow their post's status and post_date on save, are added and removed
+with tag changes, and are deleted along with their post or tag.
+"""
+
+from django.db.models.signals import post_save, m2m_changed
+
+from models import Post, PostTagIndex
+
+
+def index_rows(post, tag_ids):
+    return [PostTagIndex(tag_id=tag_id, post_id=post.pk, status=post.status,
+                         post_date=post.post_date)
+            for tag_id in tag_ids]
+
+
+def rebuild_post_tag_index():
+    """
+    Recreates every PostTagIndex row from the posts and their tags.
+    """
+    PostTagIndex.objects.all().delete()
+    through = Post.tags.through
+    posts = dict((post['id'], post) for post in Post.objects.values('id', 'status', 'post_date'))
+
+    rows = []
+    for post_id, tag_id in through.objects.values_list('post_id', 'tag_id').iterator():
+        post = posts[post_id]
+        rows.append(PostTagIndex(tag_id=tag_id, post_id=post_id, status=post['status'],
+                                 post_date=post['post_date']))
+    PostTagIndex.objects.bulk_create(rows, batch_size=500)
+    return len(rows)
+
+
+def post_saved(sender, instance, created, raw=False, **kwargs):
+    if raw or created:
+        return
+    PostTagIndex.objects.filter(post=instance).exclude(
+        status=instance.status, post_date=instance.post_date
+    ).update(status=instance.status, post_date=instance.post_date)
+
+
+def post_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'post_add':
+        if reverse:
+            # instance is a Tag, pk_set holds post ids
+            rows = [PostTagIndex(tag_id=instance.pk, post_id=post['id'], status=post['status'],
+                                 post_date=post['post_date'])
+                    for post in Post.objects.filter(pk__in=pk_set).values('id', 'status', 'post_date')]
+        else:
+            rows = index_rows(instance, pk_set)
+        PostTagIndex.objects.bulk_create(rows)
+
+    elif action == 'post_remove':
+        if reverse:
+            PostTagIndex.objects.filter(tag=instance, post__in=pk_set).delete()
+        else:
+            PostTagIndex.objects.filter(post=instance, tag__in=pk_set).delete()
+
+    elif action == 'post_clear':
+        if reverse:
+            PostTagIndex.objects.filter(tag=instance).delete()
+        else:
+            PostTagIndex.objects.filter(post=instance).delete()
+
+
+post_save.connect(post_saved, sender=Post, dispatch_uid='metablog.listing_index.post_saved')
+m2m_changed.connect(post_tags_changed, sender=Post.tags.through,
+                    dispatch_uid='metablog.listing_index.post_tags_changed')
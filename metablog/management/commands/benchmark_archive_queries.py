@@ -0,0 +1,97 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+from django.conf import settings
+
+from cinekine.metablog.models import Post
+
+from datetime import datetime, timedelta
+from optparse import make_option
+from time import time
+
+
+class Command(BaseCommand):
+    help = ("Times archive page queries using post_date__year/__month lookups "
+            "against the half-open date ranges used by Post.query, including a "
+            "month of every year.  Generated posts are rolled back afterwards.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--posts', type='int', dest='posts', default=100000,
+                    help='Number of posts to generate (default 100000).'),
+        make_option('--years', type='int', dest='years', default=10,
+                    help='Years the generated posts are spread over (default 10).'),
+        make_option('--repeat', type='int', dest='repeat', default=20,
+                    help='Timed runs per query (default 20).'),
+    )
+
+    @transaction.commit_manually
+    def handle(self, *args, **options):
+        try:
+            self.generate_posts(options['posts'], options['years'])
+            self.run(options['years'], options['repeat'])
+        finally:
+            transaction.rollback()
+
+    def generate_posts(self, count, years):
+        author = User.objects.create(username='metablog-benchmark')
+        first = datetime(2000, 1, 1)
+        step = timedelta(days=365 * years) / count
+
+        post_date_field = Post._meta.get_field('post_date')
+        post_date_field.auto_now_add = False
+        try:
+            posts = []
+            for index in xrange(count):
+                post_date = first + step * index
+                if settings.USE_TZ:
+                    post_date = timezone.make_aware(post_date, timezone.utc)
+                posts.append(Post(author=author, title='Post %d' % index, slug='post-%d' % index,
+                                  post_date=post_date, create_date=post_date,
+                                  status=(Post.PUBLISHED, Post.DRAFT, Post.CLOSED)[index % 3],
+                                  text=''))
+            Post.objects.bulk_create(posts, batch_size=1000)
+        finally:
+            post_date_field.auto_now_add = True
+
+        cursor = connection.cursor()
+        if connection.vendor == 'postgresql':
+            cursor.execute('ANALYZE metablog_post')
+        elif connection.vendor == 'sqlite':
+            cursor.execute('ANALYZE')
+        self.stdout.write("Generated %d posts.\n" % count)
+
+    def run(self, years, repeat):
+        statuses = Post.visible_statuses(False)
+        pages = [(2000 + years / 2, 0), (2000 + years / 2, 6), (2000 + years - 1, 12), (0, 6)]
+
+        for year, month in pages:
+            lookups = Post.objects.filter(status__in=statuses)
+            if year:
+                lookups = lookups.filter(post_date__year=year)
+            if month:
+                lookups = lookups.filter(post_date__month=month)
+            lookups = lookups.order_by('-post_date', '-id')
+            ranges = Post.query(statuses, year=year, month=month)
+
+            if year:
+                label = '%d/%02d' % (year, month) if month else '%d' % year
+            else:
+                label = 'every %02d' % month
+            self.stdout.write("archive %s:\n" % label)
+            for name, posts in (('year/month lookups', lookups), ('date range', ranges)):
+                self.stdout.write("  %-20s %8.2f ms (%d posts)\n" % (
+                    name, self.time_page(posts, repeat), posts.count()))
+
+    def time_page(self, posts, repeat):
+        """
+        Median time to fetch the first listing page of posts.
+        """
+        per_page = settings.CK_METABLOG_PER_PAGE_COUNT
+        timings = []
+        for run in range(repeat):
+            started = time()
+            list(posts[:per_page])
+            timings.append((time() - started) * 1000.0)
+        timings.sort()
+        return timings[len(timings) / 2]
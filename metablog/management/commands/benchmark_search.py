@@ -0,0 +1,69 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.conf import settings
+
+from cinekine.metablog.models import Post
+from cinekine.metablog.search import search_posts, get_backend
+
+from optparse import make_option
+from random import Random
+from time import time
+
+
+WORDS = ('engine', 'sprite', 'shader', 'render', 'physics', 'audio', 'level', 'editor',
+         'script', 'network', 'texture', 'camera', 'input', 'memory', 'thread', 'profile')
+
+
+class Command(BaseCommand):
+    help = ("Times the first results page of searches over generated posts, with the "
+            "search backend chosen by CK_METABLOG_SEARCH_BACKEND.  Generated posts and "
+            "their index are rolled back afterwards.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--posts', type='int', dest='posts', default=100000,
+                    help='Number of posts to generate (default 100000).'),
+        make_option('--repeat', type='int', dest='repeat', default=20,
+                    help='Timed runs per query (default 20).'),
+    )
+
+    @transaction.commit_manually
+    def handle(self, *args, **options):
+        try:
+            self.generate_posts(options['posts'])
+            started = time()
+            # not rebuild_index(), whose commit_on_success would commit the posts
+            get_backend().rebuild()
+            self.stdout.write("Indexed in %.1f s.\n" % (time() - started))
+            if connection.vendor in ('postgresql', 'sqlite'):
+                connection.cursor().execute('ANALYZE')
+            self.run(options['repeat'])
+        finally:
+            transaction.rollback()
+
+    def generate_posts(self, count):
+        author = User.objects.create(username='metablog-benchmark')
+        random = Random(0)
+        posts = []
+        for index in xrange(count):
+            text = u' '.join(random.choice(WORDS) for word in range(200))
+            posts.append(Post(author=author, title=u'%s %d' % (random.choice(WORDS), index),
+                              slug='post-%d' % index, text=u'<p>%s</p>' % text,
+                              status=(Post.PUBLISHED, Post.DRAFT, Post.CLOSED)[index % 3],
+                              search_priority=(Post.NORMAL, Post.PREFERRED, Post.HIGHLIGHTED)[index % 3]))
+        Post.objects.bulk_create(posts, batch_size=1000)
+        self.stdout.write("Generated %d posts.\n" % count)
+
+    def run(self, repeat):
+        public = Post.query(Post.visible_statuses(False))
+        per_page = settings.CK_METABLOG_PER_PAGE_COUNT
+        for query in ('shader', 'engine physics', 'missing'):
+            timings = []
+            for run in range(repeat):
+                started = time()
+                results = search_posts(query, public)
+                results.count()
+                list(results[:per_page])
+                timings.append((time() - started) * 1000.0)
+            timings.sort()
+            self.stdout.write("  %-20s %8.2f ms\n" % (query, timings[len(timings) / 2]))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from cinekine.metablog.static_export import export_site, ExportError
+
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    args = '<output>'
+    help = ("Exports the public blog as static files.  <output> becomes a symlink to "
+            "the new export; pages unchanged since the last export are reused.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', dest='processes', default=None,
+                    help='Worker processes (default: one per CPU).'),
+        make_option('--all', action='store_true', dest='all', default=False,
+                    help='Render every page again, e.g. after changing templates.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Usage: export_static_site %s" % self.args)
+        try:
+            pages, rendered, written = export_site(args[0], options['processes'], options['all'])
+        except ExportError as e:
+            raise CommandError(str(e))
+        self.stdout.write("Exported %d pages: rendered %d, %d changed.\n" % (pages, rendered, written))
@@ -0,0 +1,27 @@
+from django.core.management.base import NoArgsCommand
+
+from cinekine.metablog.ping_queue import process_pending_pings
+
+from optparse import make_option
+from time import sleep
+
+
+class Command(NoArgsCommand):
+    help = ("Sends queued search engine pings, batching pings queued close "
+            "together and retrying failures with backoff.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--loop', action='store_true', dest='loop', default=False,
+                    help='Keep running, checking the queue every --interval seconds.'),
+        make_option('--interval', type='int', dest='interval', default=15,
+                    help='Seconds between queue checks with --loop (default 15).'),
+    )
+
+    def handle_noargs(self, **options):
+        while True:
+            sent = process_pending_pings()
+            if sent:
+                self.stdout.write("Sent %d pings.\n" % sent)
+            if not options['loop']:
+                break
+            sleep(options['interval'])
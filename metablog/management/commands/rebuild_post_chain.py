@@ -0,0 +1,11 @@
+from django.core.management.base import NoArgsCommand
+
+from cinekine.metablog.navigation import rebuild_post_chain
+
+
+class Command(NoArgsCommand):
+    help = "Relinks prev_post/next_post of every post in chronological order."
+
+    def handle_noargs(self, **options):
+        count = rebuild_post_chain()
+        self.stdout.write("Linked %d posts.\n" % count)
@@ -0,0 +1,13 @@
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from cinekine.metablog.listing_index import rebuild_post_tag_index
+
+
+class Command(NoArgsCommand):
+    help = "Rebuilds the denormalized post/tag listing index from Post.tags."
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        count = rebuild_post_tag_index()
+        self.stdout.write("Indexed %d post tags.\n" % count)
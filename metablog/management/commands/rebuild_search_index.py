@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from cinekine.metablog.search import rebuild_index
+
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    help = ("Installs and rebuilds the search backend chosen by CK_METABLOG_SEARCH_BACKEND. "
+            "The inverted index tokenizes posts in parallel.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', dest='processes', default=None,
+                    help='Worker processes (default: one per CPU).'),
+    )
+
+    def handle(self, *args, **options):
+        count = rebuild_index(options['processes'])
+        self.stdout.write("Indexed %d posts.\n" % count)
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from cinekine.metablog.related import refresh_related_posts, rebuild_related_posts
+
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    help = ("Recomputes the related posts of posts changed since the last run.  "
+            "Run periodically, e.g. from cron.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--all', action='store_true', dest='all', default=False,
+                    help='Recompute the related posts of every post.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['all']:
+            count = rebuild_related_posts()
+        else:
+            count = refresh_related_posts()
+        self.stdout.write("Updated related posts of %d posts.\n" % count)
@@ -5,13 +5,25 @@ Association between tags and posts.
 """
 
 from django.db import models
+from django.db.models import Q, Min, Max
 from django.contrib.auth.models import User
 from django.utils import timezone
-from django.contrib.sitemaps import ping_google
+from django.contrib.sitemaps import PING_URL, SitemapNotFound
+from django.core.urlresolvers import reverse, NoReverseMatch
 from django.conf import settings
 
+from datetime import datetime, timedelta
+from operator import or_
+import logging
+
 from wysihtml5.fields import Wysihtml5TextField
 
+from urlbuilder import article_url, category_url, site_url
+from excerpts import summarize
+
+
+logger = logging.getLogger(__name__)
+
 
 class Tag(models.Model):
     """Tags are used for searching and organizing blog posts.
@@ -23,9 +35,8 @@ class Tag(models.Model):
         return self.name
 
     # Django Overrides
-    @models.permalink
     def get_absolute_url(self):
-        return ('metablog_category', [self.slug])
+        return category_url(self.slug)
 
 
 ################################################################################
@@ -52,8 +63,12 @@ class Post(models.Model):
     post_date = models.DateTimeField(auto_now_add=True)
     modified_date = models.DateTimeField(auto_now=True)
     status = models.SmallIntegerField(choices=STATUS_CHOICES, db_index=True)
-    prev_post = models.OneToOneField('self', related_name='next', null=True, blank=True)
-    next_post = models.OneToOneField('self', related_name='prev', null=True, blank=True)
+    # Chronological neighbors among visible posts, maintained by the
+    # navigation module.
+    prev_post = models.OneToOneField('self', related_name='next', null=True, blank=True,
+                                     editable=False, on_delete=models.SET_NULL)
+    next_post = models.OneToOneField('self', related_name='prev', null=True, blank=True,
+                                     editable=False, on_delete=models.SET_NULL)
     tags = models.ManyToManyField(Tag)
     text = Wysihtml5TextField()
     atj_word_count = models.SmallIntegerField(verbose_name='After the Jump word count', default=150)
@@ -70,62 +85,250 @@ class Post(models.Model):
     search_priority = models.SmallIntegerField(choices=PRIORITY_CHOICES, default=NORMAL)
     pings = models.SmallIntegerField(editable=False, default=0)
 
+    # Derived from text on save (see excerpts.summarize), so listings never
+    # need to load the full body.
+    excerpt = models.TextField(editable=False, default='')
+    word_count = models.PositiveIntegerField(editable=False, default=0)
+    reading_time = models.SmallIntegerField(editable=False, default=0)
+
+    # Fields updated in place by background tasks.  Saving an existing post
+    # leaves them alone so a stale instance can't overwrite them.
+    MAINTAINED_FIELDS = ('pings', 'prev_post', 'next_post')
+
     _original_status = None
+    _original_post_date = None
+
+    class Meta:
+        index_together = (('status', 'post_date'),)
 
     def __init__(self, *args, **kwargs):
         super(Post, self).__init__(*args, **kwargs)
         self._original_status = self.status
+        self._original_post_date = self.post_date
 
     def __unicode__(self):
         return self.title
 
     # Django overrides
-    @models.permalink
     def get_absolute_url(self):
-        return ('metablog_article', [self.slug])
+        return article_url(self.slug)
 
     def save(self, *args, **kwargs):
+        ping = False
         if self._original_status != self.status:
             # need to update post time if we've officially published an article.
             if self.status == Post.PUBLISHED or self.status == Post.EXCLUSIVE:
                 self.post_date = timezone.now()
-                if not settings.DEBUG and settings.CK_METABLOG_PING_GOOGLE:
-                    ping_google()
-                    self.pings += 1
+                ping = not settings.DEBUG and settings.CK_METABLOG_PING_GOOGLE
 
         if self.create_date is None:
             self.create_date = self.post_date
 
+        self.excerpt, self.word_count, self.reading_time = summarize(self.text, self.atj_word_count)
+
+        skip_maintained = not (self._state.adding or args or kwargs.get('force_insert')
+                               or 'update_fields' in kwargs)
+        if skip_maintained and not Post.objects.filter(pk=self.pk).exists():
+            # update_fields needs the row; a stale instance whose row was
+            # deleted is inserted again, as by a plain save().
+            skip_maintained = False
+        if skip_maintained:
+            kwargs['update_fields'] = [field.name for field in self._meta.local_fields
+                                       if not field.primary_key and field.name not in Post.MAINTAINED_FIELDS]
+
         super(Post, self).save(*args, **kwargs)
         self._original_status = self.status
+        self._original_post_date = self.post_date
+
+        if ping:
+            # sent (and counted in 'pings') by the process_pings command.
+            try:
+                Ping.queue_sitemap_ping(self)
+            except SitemapNotFound:
+                logger.warning("Post '%s' published without a sitemap ping: no sitemap URL "
+                               "is set or routed.", self.slug)
+
+    @staticmethod
+    def archive_date(post_date):
+        """
+        post_date in the site timezone, which decides its archive year and
+        month.
+        """
+        if settings.USE_TZ and timezone.is_aware(post_date):
+            return timezone.localtime(post_date, timezone.get_default_timezone())
+        return post_date
 
     @staticmethod
-    def query(statuses, tags=None, year=0, month=0):
+    def archive_range(year, month=0):
+        """
+        [start, end) datetimes of an archive year, or of a month if given, in
+        the site timezone.
+        """
+        if month:
+            start = datetime(year, month, 1)
+            if month == 12:
+                end = datetime(year + 1, 1, 1)
+            else:
+                end = datetime(year, month + 1, 1)
+        else:
+            start = datetime(year, 1, 1)
+            end = datetime(year + 1, 1, 1)
+
+        if settings.USE_TZ:
+            site_timezone = timezone.get_default_timezone()
+            start = timezone.make_aware(start, site_timezone)
+            end = timezone.make_aware(end, site_timezone)
+        return start, end
+
+    @staticmethod
+    def month_ranges(month):
+        """
+        A Q matching post_date in the given month of any year from the first
+        post to the last, in the site timezone.
+        """
+        bounds = Post.objects.aggregate(first=Min('post_date'), last=Max('post_date'))
+        if bounds['first'] is None:
+            return Q(pk__in=[])
+        ranges = []
+        for year in range(Post.archive_date(bounds['first']).year,
+                          Post.archive_date(bounds['last']).year + 1):
+            start, end = Post.archive_range(year, month)
+            ranges.append(Q(post_date__gte=start, post_date__lt=end))
+        return reduce(or_, ranges)
+
+    @staticmethod
+    def visible_statuses(is_admin):
+        """
+        Post statuses shown to visitors.  Admins also see drafts and hidden
+        posts.
+        """
+        statuses = [Post.PUBLISHED, Post.EXCLUSIVE, Post.CLOSED]
+        if is_admin:
+            statuses.append(Post.DRAFT)
+            statuses.append(Post.HIDDEN)
+        return statuses
+
+    @staticmethod
+    def query(statuses, tags=None, year=0, month=0, listing=False):
         """
         Standard query function for posts.  Multiple views would call this
         method to retrieve a query set.
+
+        With listing set, each post's author and tags are loaded up front, so
+        a page of posts costs the same number of queries however long it is.
+        'text' is always loaded: site listing templates show it, and feeds
+        carry it as item content.
+
+        Tag listings are filtered, sorted and paged on the PostTagIndex rows,
+        and the posts are joined to the page of rows.
         """
+        dates = {}
+        if year != 0:
+            # half-open range so the post_date index can be used.
+            start, end = Post.archive_range(int(year), int(month))
+            dates = {'post_date__gte': start, 'post_date__lt': end}
+
         if tags != None and len(tags) > 0:
+            # a single filter() call, so every condition applies to the same
+            # index row
+            conditions = dict(('posttagindex__' + lookup, value)
+                              for lookup, value in dates.items())
             posts = Post.objects.filter(
-                tags__in=tags
-            ).filter(
-                status__in=statuses
+                posttagindex__tag__in=tags,
+                posttagindex__status__in=statuses,
+                **conditions
             )
+            if len(tags) > 1:
+                # one index row per tag
+                posts = posts.distinct()
+            order = ("-posttagindex__post_date", "-posttagindex__post")
         else:
             posts = Post.objects.filter(
-                status__in=statuses
+                status__in=statuses,
+                **dates
             )
+            order = ("-post_date", "-id")
 
-        if year != 0:
-            posts = posts.filter(
-                post_date__year=year
-            )
-        if month != 0:
-            posts = posts.filter(
-                post_date__month=month
-            )
+        if year == 0 and month != 0:
+            # the month of every year with posts, as half-open ranges too
+            posts = posts.filter(Post.month_ranges(int(month)))
 
-        return posts.order_by("-post_date")
+        if listing:
+            posts = posts.select_related('author').prefetch_related('tags')
+
+        return posts.order_by(*order)
+
+
+################################################################################
+
+class PostTagIndex(models.Model):
+    """Denormalized (tag, status, post_date, post) rows for tag listings.
+
+    One row per post and tag, kept in sync with Post and Post.tags by the
+    handlers in listing_index.  Tag listings read their posts off its
+    composite index in (post_date, post) order, instead of joining the tags
+    table and sorting the post table; Post.query() joins each page of rows to
+    its posts.
+    """
+    tag = models.ForeignKey(Tag)
+    post = models.ForeignKey(Post)
+    status = models.SmallIntegerField()
+    post_date = models.DateTimeField()
+
+    class Meta:
+        unique_together = (('tag', 'post'),)
+        index_together = (('tag', 'status', 'post_date', 'post'),)
+
+    def __unicode__(self):
+        return "%s-%s" % (self.tag_id, self.post_id)
+
+
+################################################################################
+
+class SearchPosting(models.Model):
+    """A term of the full-text search index and its weight in one post.
+
+    Maintained by the search module from a post's title, description, tag
+    names and text.
+    """
+    term = models.CharField(max_length=32)
+    post = models.ForeignKey(Post)
+    weight = models.FloatField()
+
+    class Meta:
+        unique_together = (('term', 'post'),)
+
+    def __unicode__(self):
+        return "%s-%s" % (self.term, self.post_id)
+
+
+################################################################################
+
+class RelatedPost(models.Model):
+    """One of the posts most related to a post, by rank.
+
+    Computed in the background by the related module from shared tags and
+    the similarity of the posts' text.
+    """
+    post = models.ForeignKey(Post, related_name='related_entries')
+    related = models.ForeignKey(Post, related_name='+')
+    rank = models.SmallIntegerField()
+    score = models.FloatField()
+
+    class Meta:
+        unique_together = (('post', 'rank'),)
+
+    def __unicode__(self):
+        return "%s-%s" % (self.post_id, self.related_id)
+
+
+class RelatedPostsUpdate(models.Model):
+    """A post whose related posts are due to be recomputed."""
+    post = models.OneToOneField(Post, primary_key=True)
+    queued_date = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return unicode(self.post_id)
 
 
 ################################################################################
@@ -146,9 +349,8 @@ class Category(models.Model):
         return self.long_name
 
     # Django Overrides
-    @models.permalink
     def get_absolute_url(self):
-        return ('metablog_category', [self.tag.slug])
+        return category_url(self.tag.slug)
 
 
 ################################################################################
@@ -218,3 +420,103 @@ class Link(models.Model):
 
     def __unicode__(self):
         return self.title
+
+
+################################################################################
+
+class Ping(models.Model):
+    """
+    An outbound notification queued for the process_pings command: a
+    sitemap ping to a search engine, or a WebSub publish notice telling a
+    hub that a feed changed.
+
+    Pings for the same endpoint that are pending together are sent as one
+    request.  Failed sends are retried with exponential backoff.
+    """
+    SITEMAP = 0
+    WEBSUB = 1
+    KIND_CHOICES = (
+        (SITEMAP, 'Sitemap'),
+        (WEBSUB, 'WebSub'),
+    )
+
+    PENDING = 0
+    SENT = 1
+    FAILED = 2
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    )
+
+    kind = models.SmallIntegerField(choices=KIND_CHOICES, default=SITEMAP)
+    endpoint = models.URLField()
+    url = models.URLField()
+    post = models.ForeignKey(Post, null=True, blank=True, on_delete=models.SET_NULL)
+    status = models.SmallIntegerField(choices=STATUS_CHOICES, default=PENDING)
+    create_date = models.DateTimeField(auto_now_add=True)
+    due_date = models.DateTimeField()
+    sent_date = models.DateTimeField(null=True, blank=True)
+    attempts = models.SmallIntegerField(default=0)
+    last_error = models.CharField(max_length=255, blank=True)
+
+    class Meta:
+        index_together = (('status', 'due_date'),)
+
+    def __unicode__(self):
+        return "%s (%s)" % (self.url, self.get_status_display())
+
+    @staticmethod
+    def sitemap_url():
+        """
+        Full URL of the sitemap announced to search engines: the
+        CK_METABLOG_PING_SITEMAP_URL setting, or else metablog's sitemap
+        index or the django.contrib.sitemaps views, whichever is routed.
+        """
+        if getattr(settings, 'CK_METABLOG_PING_SITEMAP_URL', None):
+            return settings.CK_METABLOG_PING_SITEMAP_URL
+
+        try:
+            url = reverse('metablog_sitemap')
+        except NoReverseMatch:
+            url = None
+        try:
+            url = url or reverse('django.contrib.sitemaps.views.index')
+        except NoReverseMatch:
+            try:
+                url = reverse('django.contrib.sitemaps.views.sitemap')
+            except NoReverseMatch:
+                raise SitemapNotFound("You didn't provide a sitemap_url, and the sitemap URL couldn't be auto-detected.")
+        return site_url(url)
+
+    @staticmethod
+    def queue_sitemap_ping(post=None):
+        """
+        Queues a sitemap ping.  It is held for CK_METABLOG_PING_WINDOW seconds
+        so pings from posts published close together go out as one.
+        """
+        window = getattr(settings, 'CK_METABLOG_PING_WINDOW', 60)
+        return Ping.objects.create(
+            kind=Ping.SITEMAP,
+            endpoint=getattr(settings, 'CK_METABLOG_PING_URL', PING_URL),
+            url=Ping.sitemap_url(),
+            post=post,
+            due_date=timezone.now() + timedelta(seconds=window)
+        )
+
+
+################################################################################
+# Signal handlers for data derived from the models above.  They are imported
+# last so the handler modules can import the models themselves.
+
+import archive_tree
+import sidebar
+import taxonomy
+import listing_index
+import search
+import related
+import navigation
+import feed_cache
+import websub
+import page_cache
+import sitemap
@@ -0,0 +1,160 @@
+"""@package docstring
+Keeps Post.prev_post and Post.next_post linking the publicly visible posts
+in (post_date, id) order, so an article page reads its neighbors from the
+post itself.
+
+A post whose status or post_date changes is unlinked from its old neighbors,
+which are joined together, and linked between its new ones.  Deleting a post
+links its neighbors again.  rebuild_post_chain() relinks every post in one pass.
+
+Relinking runs in the caller's transaction when there is one, such as the
+admin's or TransactionMiddleware's, and in a transaction of its own
+otherwise.
+"""
+
+from django.db import connection, transaction
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+
+from models import Post
+
+from functools import wraps
+
+
+def own_transaction(func):
+    """
+    Runs func in a transaction unless the caller already manages one.
+    commit_on_success does not nest, and would commit the caller's
+    transaction partway through.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if transaction.is_managed():
+            return func(*args, **kwargs)
+        return transaction.commit_on_success(func)(*args, **kwargs)
+    return wrapper
+
+
+def chain_links(post_ids):
+    """
+    Returns [(post id, prev post id, next post id)] for ids in chronological
+    order.
+    """
+    links = []
+    for index, post_id in enumerate(post_ids):
+        prev_id = post_ids[index - 1] if index > 0 else None
+        next_id = post_ids[index + 1] if index + 1 < len(post_ids) else None
+        links.append((post_id, prev_id, next_id))
+    return links
+
+
+@own_transaction
+def rebuild_post_chain():
+    """
+    Relinks every post.  Returns the number of linked posts.
+    """
+    post_ids = list(Post.objects.filter(
+        status__in=Post.visible_statuses(False)
+    ).order_by('post_date', 'id').values_list('id', flat=True))
+
+    Post.objects.exclude(prev_post=None, next_post=None).update(prev_post=None, next_post=None)
+
+    qn = connection.ops.quote_name
+    connection.cursor().executemany(
+        'UPDATE %s SET %s = %%s, %s = %%s WHERE %s = %%s' % (
+            qn(Post._meta.db_table), qn('prev_post_id'), qn('next_post_id'), qn('id')),
+        [(prev_id, next_id, post_id) for post_id, prev_id, next_id in chain_links(post_ids)])
+    return len(post_ids)
+
+
+def join(prev_id, next_id):
+    if prev_id is not None:
+        Post.objects.filter(pk=prev_id).update(next_post=next_id)
+    if next_id is not None:
+        Post.objects.filter(pk=next_id).update(prev_post=prev_id)
+
+
+def unlink(post_id):
+    """
+    Takes a post out of the chain, joining its neighbors.
+    """
+    prev_id = Post.objects.filter(next_post=post_id).values_list('id', flat=True)[:1]
+    next_id = Post.objects.filter(prev_post=post_id).values_list('id', flat=True)[:1]
+    prev_id = prev_id[0] if prev_id else None
+    next_id = next_id[0] if next_id else None
+
+    Post.objects.filter(pk=post_id).update(prev_post=None, next_post=None)
+    join(prev_id, next_id)
+
+
+def neighbors(post):
+    """
+    The ids of the visible posts just before and just after a post.
+    """
+    visible = Post.objects.filter(status__in=Post.visible_statuses(False)).exclude(pk=post.pk)
+    before = visible.filter(
+        Q(post_date__lt=post.post_date) | Q(post_date=post.post_date, id__lt=post.pk)
+    ).order_by('-post_date', '-id').values_list('id', flat=True)[:1]
+    after = visible.filter(
+        Q(post_date__gt=post.post_date) | Q(post_date=post.post_date, id__gt=post.pk)
+    ).order_by('post_date', 'id').values_list('id', flat=True)[:1]
+    return (before[0] if before else None), (after[0] if after else None)
+
+
+@own_transaction
+def relink(post):
+    """
+    Moves a post to its place in the chain, or out of it if it isn't
+    visible.
+    """
+    unlink(post.pk)
+    prev_id = next_id = None
+    if post.status in Post.visible_statuses(False):
+        prev_id, next_id = neighbors(post)
+        if prev_id is not None:
+            Post.objects.filter(pk=prev_id).update(next_post=post.pk)
+        if next_id is not None:
+            Post.objects.filter(pk=next_id).update(prev_post=post.pk)
+        Post.objects.filter(pk=post.pk).update(prev_post=prev_id, next_post=next_id)
+    post.prev_post_id = prev_id
+    post.next_post_id = next_id
+
+
+def post_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    visible = Post.visible_statuses(False)
+    if created:
+        if instance.status in visible:
+            relink(instance)
+    else:
+        # Post.save() resets the _original_ values after this signal
+        was_visible = instance._original_status in visible
+        is_visible = instance.status in visible
+        if was_visible != is_visible or (is_visible and
+                                         instance.post_date != instance._original_post_date):
+            relink(instance)
+
+
+def relink_neighbors(post):
+    """
+    Links the visible posts just before and after a deleted post to each
+    other and to their own outer neighbors.
+    """
+    neighbor_ids = [post_id for post_id in neighbors(post) if post_id is not None]
+    for neighbor in Post.objects.filter(pk__in=neighbor_ids).only('id', 'post_date'):
+        prev_id, next_id = neighbors(neighbor)
+        Post.objects.filter(pk=neighbor.pk).update(prev_post=prev_id, next_post=next_id)
+
+
+def post_deleted(sender, instance, **kwargs):
+    # the delete's SET_NULL update clears both links of a post that pointed
+    # at this one (Django 1.5 runs one UPDATE for all of a model's fields),
+    # and when several posts go at once they are all gone by now, so the
+    # posts left around it are linked again from scratch
+    if instance.status in Post.visible_statuses(False):
+        own_transaction(relink_neighbors)(instance)
+
+
+post_save.connect(post_saved, sender=Post, dispatch_uid='metablog.navigation.post_saved')
+post_delete.connect(post_deleted, sender=Post, dispatch_uid='metablog.navigation.post_deleted')
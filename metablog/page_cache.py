@@ -0,0 +1,195 @@
+"""@package docstring
+Rendered pages for anonymous visitors, cached with the objects they show.
+
+A cached page records the state of everything it was rendered from as
+{cache key: value}: the generations of its posts and tags, the version of
+the public archive tree, and the generations of the category list, the
+blogroll and the related posts.  The page is served only while all of those
+still hold the recorded values, so a change drops just the pages showing the
+changed object.  Saving a post bumps its own generation, retagging it bumps
+those of the tags involved, and Category, Tag and Link changes bump the
+sidebar's.  A post that is added, removed, published or moved also bumps the
+listings generation every page depends on.
+
+Generations are bumped again once the saving request has committed, and a
+page records the generations known before it was rendered from the
+database where it can, so a page rendered from rows read before a commit is
+never stored as current.
+
+Authenticated visitors see DRAFT and HIDDEN posts and always get a freshly
+rendered page, so cached pages vary on Cookie.  Pages that used the CSRF
+token or set cookies are not cached, being particular to one visitor.
+CK_METABLOG_PAGE_CACHE = False turns the cache off.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+
+from models import Post, Category, Tag, Link
+from archive_tree import get_archive_tree, archive_version_key
+from caching import get_generations, bump_generation_on_commit
+from compression import compress_variants, variant_response
+
+from functools import wraps
+from hashlib import md5
+
+
+PAGE_KEY = 'metablog:page:%s'
+
+CATEGORIES_GENERATION = 'page:categories'
+BLOGROLL_GENERATION = 'page:blogroll'
+LISTINGS_GENERATION = 'page:listings'
+
+
+def page_cache_enabled():
+    return getattr(settings, 'CK_METABLOG_PAGE_CACHE', True)
+
+
+def _cache_timeout():
+    return getattr(settings, 'CK_METABLOG_PAGE_CACHE_TIMEOUT', 60 * 60 * 24)
+
+
+def post_generation(post_id):
+    return 'page:post:%d' % post_id
+
+
+def tag_generation(tag_id):
+    return 'page:tag:%d' % tag_id
+
+
+def depends_on(request, *names):
+    """
+    Records generations the page rendered for request depends on.
+    """
+    dependencies = getattr(request, '_page_dependencies', None)
+    if dependencies is not None:
+        dependencies.update(names)
+
+
+def page_key(request):
+    return PAGE_KEY % md5(request.build_absolute_uri()).hexdigest()
+
+
+def page_entry(response, dependencies):
+    content = response.content
+    return {
+        'content': content,
+        'variants': compress_variants(content),
+        'content_type': response['Content-Type'],
+        'etag': md5(content).hexdigest(),
+        'last_modified': timezone.now().replace(microsecond=0),
+        'vary': response.get('Vary'),
+        'dependencies': dependencies,
+    }
+
+
+def current_entry(key):
+    """
+    The cached page under key, if everything it depends on is unchanged.
+    """
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    dependencies = entry['dependencies']
+    if cache.get_many(dependencies.keys()) != dependencies:
+        return None
+    return entry
+
+
+def cached_page(view):
+    """
+    Serves a view's pages to anonymous visitors from the page cache.  The
+    view declares what a page shows with depends_on().
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if (not page_cache_enabled() or request.method not in ('GET', 'HEAD')
+                or request.user.is_authenticated()):
+            return view(request, *args, **kwargs)
+
+        key = page_key(request)
+        entry = current_entry(key)
+        if entry is None:
+            base = set([CATEGORIES_GENERATION, BLOGROLL_GENERATION, LISTINGS_GENERATION])
+            # read before rendering: a change committed during the render
+            # leaves the entry out of date
+            dependencies = get_generations(base)
+            dependencies[archive_version_key(False)] = get_archive_tree(False).version
+            request._page_dependencies = set(base)
+            response = view(request, *args, **kwargs)
+            if (response.status_code != 200 or response.streaming or response.cookies
+                    or request.META.get('CSRF_COOKIE_USED')):
+                patch_vary_headers(response, ('Cookie',))
+                return response
+
+            dependencies.update(get_generations(request._page_dependencies - base))
+            entry = page_entry(response, dependencies)
+            cache.set(key, entry, _cache_timeout())
+
+        response = variant_response(request, entry['content'], entry['variants'],
+                                    entry['content_type'], entry['etag'], entry['last_modified'])
+        if entry['vary']:
+            patch_vary_headers(response, [header.strip() for header in entry['vary'].split(',')])
+        patch_vary_headers(response, ('Cookie',))
+        return response
+
+    return wrapper
+
+
+def post_changed(sender, instance, raw=False, created=False, **kwargs):
+    if raw:
+        return
+    bump_generation_on_commit(post_generation(instance.pk))
+    # Post.save() resets the _original_ values after this signal
+    if (created or kwargs['signal'] is post_delete
+            or instance.status != instance._original_status
+            or instance.post_date != instance._original_post_date):
+        bump_generation_on_commit(LISTINGS_GENERATION)
+
+
+def post_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse:
+        tag_ids, post_ids = [instance.pk], pk_set or Post.objects.filter(
+            tags=instance).values_list('id', flat=True)
+    elif action == 'pre_clear':
+        tag_ids, post_ids = instance.tags.values_list('id', flat=True), [instance.pk]
+    else:
+        tag_ids, post_ids = pk_set, [instance.pk]
+    for tag_id in tag_ids:
+        bump_generation_on_commit(tag_generation(tag_id))
+    for post_id in post_ids:
+        bump_generation_on_commit(post_generation(post_id))
+
+
+def invalidate_categories(sender, raw=False, **kwargs):
+    if not raw:
+        bump_generation_on_commit(CATEGORIES_GENERATION)
+
+
+def invalidate_blogroll(sender, raw=False, **kwargs):
+    if not raw:
+        bump_generation_on_commit(BLOGROLL_GENERATION)
+
+
+post_save.connect(post_changed, sender=Post, dispatch_uid='metablog.page_cache.post_saved')
+post_delete.connect(post_changed, sender=Post, dispatch_uid='metablog.page_cache.post_deleted')
+m2m_changed.connect(post_tags_changed, sender=Post.tags.through,
+                    dispatch_uid='metablog.page_cache.post_tags_changed')
+
+# tag names show in post listings and the category list, and the blogroll
+# is found by its tag
+for model in (Category, Tag):
+    post_save.connect(invalidate_categories, sender=model,
+                      dispatch_uid='metablog.page_cache.saved.%s' % model.__name__)
+    post_delete.connect(invalidate_categories, sender=model,
+                        dispatch_uid='metablog.page_cache.deleted.%s' % model.__name__)
+for model in (Tag, Link):
+    post_save.connect(invalidate_blogroll, sender=model,
+                      dispatch_uid='metablog.page_cache.blogroll_saved.%s' % model.__name__)
+    post_delete.connect(invalidate_blogroll, sender=model,
+                        dispatch_uid='metablog.page_cache.blogroll_deleted.%s' % model.__name__)
@@ -0,0 +1,113 @@
+"""@package docstring
+Keyset (cursor) pagination for post listings.
+
+Pages are found by seeking past the (post_date, id) of the last post shown
+rather than by OFFSET, and without counting the listing.  Cursors are opaque
+tokens carrying a direction and the position to seek from.
+"""
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from calendar import timegm
+from datetime import datetime, timedelta
+
+
+# Pagination modes (setting CK_METABLOG_PAGINATION.)
+PAGINATE_OFFSET = 'offset'
+PAGINATE_CURSOR = 'cursor'
+
+# Cursor directions
+OLDER = 'o'
+NEWER = 'n'
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def pagination_mode():
+    return getattr(settings, 'CK_METABLOG_PAGINATION', PAGINATE_OFFSET)
+
+
+def encode_cursor(direction, post):
+    post_date = post.post_date
+    if timezone.is_aware(post_date):
+        post_date = timezone.make_naive(post_date, timezone.utc)
+    delta = post_date - EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    token = '%s.%d.%d' % (direction, micros, post.id)
+    return urlsafe_b64encode(token).rstrip('=')
+
+
+def decode_cursor(token):
+    """
+    Returns (direction, post_date, post id), or None for a malformed token.
+    """
+    try:
+        token = urlsafe_b64decode(str(token) + '=' * (-len(token) % 4))
+        direction, micros, post_id = token.split('.')
+        post_date = EPOCH + timedelta(microseconds=int(micros))
+        post_id = int(post_id)
+    except (TypeError, ValueError, OverflowError, UnicodeEncodeError):
+        return None
+
+    if direction not in (OLDER, NEWER):
+        return None
+    if settings.USE_TZ:
+        post_date = timezone.make_aware(post_date, timezone.utc)
+    return direction, post_date, post_id
+
+
+def cursor_page(all_posts, cursor, post_page_count, article_post_index=0):
+    """
+    Returns one page of all_posts, which must be ordered latest first by
+    (post_date, id), as in Post.query.
+
+    With no cursor the page starts at article_post_index, so old start=
+    links still resolve; like cull_posts, a start past the end shows the
+    last post.  Returns the posts, the id of the first post, and
+    cursors for the newer and older pages (None if there is none), named
+    next and prev as in cull_posts.
+    """
+    position = decode_cursor(cursor) if cursor else None
+
+    if position is None:
+        article_post_index = max(article_post_index, 0)
+        posts = list(all_posts[article_post_index:article_post_index + post_page_count + 1])
+        if not posts and article_post_index > 0:
+            # only counted for a start= past the end
+            article_post_index = max(all_posts.count() - 1, 0)
+            posts = list(all_posts[article_post_index:article_post_index + post_page_count + 1])
+        has_newer = article_post_index > 0
+        has_older = len(posts) > post_page_count
+        posts = posts[:post_page_count]
+    else:
+        direction, post_date, post_id = position
+        if direction == OLDER:
+            posts = list(all_posts.filter(
+                Q(post_date__lt=post_date) | Q(post_date=post_date, id__lt=post_id)
+            )[:post_page_count + 1])
+            has_newer = True
+            has_older = len(posts) > post_page_count
+            posts = posts[:post_page_count]
+        else:
+            posts = list(all_posts.filter(
+                Q(post_date__gt=post_date) | Q(post_date=post_date, id__gt=post_id)
+            ).reverse()[:post_page_count + 1])
+            has_newer = len(posts) > post_page_count
+            has_older = True
+            posts = posts[:post_page_count]
+            posts.reverse()
+
+    if not posts:
+        return None, None, None, None
+
+    next_cursor = None
+    if has_newer:
+        next_cursor = encode_cursor(NEWER, posts[0])
+    prev_cursor = None
+    if has_older:
+        prev_cursor = encode_cursor(OLDER, posts[-1])
+
+    return posts, posts[0].id, next_cursor, prev_cursor
@@ -0,0 +1,123 @@
+"""@package docstring
+Sends queued Ping rows.  Run by the process_pings management command.
+
+Pending pings are grouped by kind and endpoint; a group is sent as soon as
+its earliest ping is due, carrying every ping queued for it since.  A failed
+group is retried with exponential backoff until CK_METABLOG_PING_MAX_ATTEMPTS.
+"""
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Min
+from django.utils import timezone
+
+from models import Post, Ping
+
+from datetime import timedelta
+from urllib import urlencode
+import urllib2
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def send_sitemap_ping(endpoint, urls, timeout):
+    for url in urls:
+        urllib2.urlopen('%s?%s' % (endpoint, urlencode({'sitemap': url})), timeout=timeout).read()
+
+
+def send_websub_publish(endpoint, urls, timeout):
+    # one publish request naming every changed feed
+    data = urlencode([('hub.mode', 'publish')] + [('hub.url', url) for url in urls])
+    urllib2.urlopen(endpoint, data, timeout=timeout).read()
+
+
+# Ping kind -> function(endpoint, announced urls, timeout)
+SENDERS = {
+    Ping.SITEMAP: send_sitemap_ping,
+    Ping.WEBSUB: send_websub_publish,
+}
+
+
+def retry_delay(attempts):
+    return timedelta(seconds=_setting('CK_METABLOG_PING_RETRY_DELAY', 60) * 2 ** (attempts - 1))
+
+
+def claim_group(kind, endpoint, now, timeout):
+    """
+    Takes the pending pings of one kind and endpoint if the group is due,
+    moving their due_date past the time a send can take so no other run
+    sends them meanwhile.  The claim is committed before anything is sent,
+    so no row stays locked during the requests; a run that dies mid-send
+    leaves its pings to be retried once the claim runs out.
+    """
+    with transaction.commit_on_success():
+        pings = list(Ping.objects.select_for_update().filter(
+            kind=kind, endpoint=endpoint, status=Ping.PENDING))
+        if not pings or min(ping.due_date for ping in pings) > now:
+            return []
+        Ping.objects.filter(pk__in=[ping.pk for ping in pings]).update(
+            due_date=now + timedelta(seconds=timeout * (len(pings) + 1)))
+    return pings
+
+
+def send_group(kind, endpoint, now):
+    """
+    Sends every pending ping of one kind to one endpoint as a single batch.
+    Returns the number of pings sent.
+    """
+    timeout = _setting('CK_METABLOG_PING_TIMEOUT', 10)
+    pings = claim_group(kind, endpoint, now, timeout)
+    if not pings:
+        return 0
+
+    urls = []
+    for ping in pings:
+        if ping.url not in urls:
+            urls.append(ping.url)
+
+    try:
+        SENDERS[kind](endpoint, urls, timeout)
+    except Exception, e:
+        attempts = max(ping.attempts for ping in pings) + 1
+        status = Ping.PENDING
+        if attempts >= _setting('CK_METABLOG_PING_MAX_ATTEMPTS', 8):
+            status = Ping.FAILED
+        Ping.objects.filter(pk__in=[ping.pk for ping in pings]).update(
+            attempts=attempts, status=status, due_date=now + retry_delay(attempts),
+            last_error=unicode(e)[:255])
+        return 0
+
+    with transaction.commit_on_success():
+        Ping.objects.filter(pk__in=[ping.pk for ping in pings]).update(
+            status=Ping.SENT, sent_date=now, attempts=F('attempts') + 1)
+
+        # 'pings' counts search engine pings only
+        post_ids = set(ping.post_id for ping in pings
+                       if ping.post_id is not None and ping.kind == Ping.SITEMAP)
+        if post_ids:
+            Post.objects.filter(pk__in=post_ids).update(pings=F('pings') + 1)
+    return len(pings)
+
+
+def process_pending_pings(now=None):
+    """
+    Sends every group of pings that is due.  Returns the number of pings
+    sent.
+    """
+    if now is None:
+        now = timezone.now()
+
+    groups = Ping.objects.filter(
+        status=Ping.PENDING
+    ).values(
+        'kind', 'endpoint'
+    ).annotate(
+        first_due_date=Min('due_date')
+    ).filter(first_due_date__lte=now).order_by()
+
+    sent = 0
+    for group in list(groups):
+        sent += send_group(group['kind'], group['endpoint'], now)
+    return sent
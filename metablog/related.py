@@ -0,0 +1,273 @@
+"""@package docstring
+Related posts, precomputed into RelatedPost.
+
+A post's relation to another is a weighted sum of the Jaccard similarity of
+their tags and the cosine similarity of TF-IDF vectors of their title and
+stripped text.  Vectors are sparse {term: weight} dictionaries, and a post is
+scored against the whole blog at once by walking the term and tag postings it
+shares with other posts, so only overlapping posts are ever touched.
+
+Saving a post or changing its tags queues a RelatedPostsUpdate; the
+refresh_related_posts command recomputes the queued posts and patches the
+lists of posts they enter or leave.  Only publicly visible posts are offered
+as related posts.
+"""
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save, pre_delete, m2m_changed
+
+from models import Post, RelatedPost, RelatedPostsUpdate
+from excerpts import plain_text
+from search import tokenize
+from caching import bump_generation
+
+from heapq import nlargest
+from math import log, sqrt
+
+
+# Bumped whenever stored related posts change.
+RELATED_GENERATION = 'related'
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def related_posts_count():
+    return _setting('CK_METABLOG_RELATED_POSTS_COUNT', 5)
+
+
+def term_counts(title, text):
+    counts = {}
+    for term in tokenize(u'%s %s' % (title, plain_text(text or u''))):
+        counts[term] = counts.get(term, 0) + 1
+    return counts
+
+
+class RelatedCorpus(object):
+    """
+    TF-IDF vectors and tag sets of every publicly visible post, with term
+    and tag postings for scoring a post against all of them.
+    """
+
+    def __init__(self):
+        self.tag_weight = _setting('CK_METABLOG_RELATED_TAG_WEIGHT', 0.5)
+        self.count = related_posts_count()
+
+        self.tags = {}
+        through = Post.tags.through
+        for post_id, tag_id in through.objects.values_list('post_id', 'tag_id').iterator():
+            self.tags.setdefault(post_id, set()).add(tag_id)
+
+        candidates = Post.objects.filter(
+            status__in=Post.visible_statuses(False)
+        ).values_list('id', 'title', 'text')
+
+        counts = {}
+        for post_id, title, text in candidates.iterator():
+            counts[post_id] = term_counts(title, text)
+        self.candidates = set(counts)
+
+        document_frequency = {}
+        for terms in counts.itervalues():
+            for term in terms:
+                document_frequency[term] = document_frequency.get(term, 0) + 1
+        self.idf = dict((term, log(float(1 + len(counts)) / (1 + df)) + 1.0)
+                        for term, df in document_frequency.iteritems())
+
+        self.vectors = {}
+        self.term_postings = {}
+        for post_id, terms in counts.iteritems():
+            vector = self.vector(terms)
+            self.vectors[post_id] = vector
+            for term, weight in vector.iteritems():
+                self.term_postings.setdefault(term, []).append((post_id, weight))
+
+        self.tag_postings = {}
+        for post_id in self.candidates:
+            for tag_id in self.tags.get(post_id, ()):
+                self.tag_postings.setdefault(tag_id, []).append(post_id)
+
+    def vector(self, counts):
+        """
+        Unit-length TF-IDF vector of a post's term counts.  Terms unknown to
+        the corpus are left out, since no candidate could share them.
+        """
+        vector = {}
+        for term, count in counts.iteritems():
+            if term in self.idf:
+                vector[term] = (1.0 + log(count)) * self.idf[term]
+        norm = sqrt(sum(weight * weight for weight in vector.itervalues()))
+        if norm:
+            for term in vector:
+                vector[term] /= norm
+        return vector
+
+    def scores(self, post_id, vector, tags):
+        """
+        Returns {candidate id: score} for every candidate sharing a term or a
+        tag with a post.
+        """
+        text_weight = 1.0 - self.tag_weight
+        scores = {}
+        for term, weight in vector.iteritems():
+            for other_id, other_weight in self.term_postings.get(term, ()):
+                scores[other_id] = scores.get(other_id, 0.0) + text_weight * weight * other_weight
+
+        shared = {}
+        for tag_id in tags:
+            for other_id in self.tag_postings.get(tag_id, ()):
+                shared[other_id] = shared.get(other_id, 0) + 1
+        for other_id, count in shared.iteritems():
+            union = len(tags) + len(self.tags[other_id]) - count
+            scores[other_id] = scores.get(other_id, 0.0) + self.tag_weight * count / union
+
+        scores.pop(post_id, None)
+        return scores
+
+    def post_scores(self, post_id, title, text):
+        vector = self.vectors.get(post_id)
+        if vector is None:
+            vector = self.vector(term_counts(title, text))
+        return self.scores(post_id, vector, self.tags.get(post_id, set()))
+
+    def top(self, scores):
+        """
+        The best (score, related id) pairs, highest first.
+        """
+        return nlargest(self.count, ((score, other_id) for other_id, score in scores.iteritems()
+                                     if score > 0.0))
+
+
+def entries(post_id, top):
+    return [RelatedPost(post_id=post_id, related_id=related_id, rank=rank, score=score)
+            for rank, (score, related_id) in enumerate(top)]
+
+
+@transaction.commit_on_success
+def rebuild_related_posts():
+    """
+    Recomputes the related posts of every post.  Returns the number of posts.
+    """
+    corpus = RelatedCorpus()
+    RelatedPost.objects.all().delete()
+    RelatedPostsUpdate.objects.all().delete()
+
+    rows = []
+    count = 0
+    for post_id, title, text in Post.objects.values_list('id', 'title', 'text').iterator():
+        rows.extend(entries(post_id, corpus.top(corpus.post_scores(post_id, title, text))))
+        count += 1
+    RelatedPost.objects.bulk_create(rows, batch_size=500)
+    bump_generation(RELATED_GENERATION)
+    return count
+
+
+@transaction.commit_on_success
+def refresh_related_posts():
+    """
+    Recomputes the related posts of queued posts, and the lists of other
+    posts that a queued post now enters, moves within or leaves.  Returns
+    the number of posts whose list was rewritten.
+    """
+    queued = set(RelatedPostsUpdate.objects.values_list('post', flat=True))
+    if not queued:
+        return 0
+    corpus = RelatedCorpus()
+
+    current = {}
+    for entry in RelatedPost.objects.all().values('post', 'related', 'score').iterator():
+        current.setdefault(entry['post'], {})[entry['related']] = entry['score']
+
+    lists = {}
+    recompute = set(queued)
+    for post_id, title, text in Post.objects.filter(pk__in=queued).values_list('id', 'title', 'text'):
+        scores = corpus.post_scores(post_id, title, text)
+        lists[post_id] = corpus.top(scores)
+
+        # patch the other lists by symmetry: score(other, post) == score(post, other)
+        if post_id not in corpus.candidates:
+            scores = {}
+        for other_id, entry in current.iteritems():
+            if other_id in queued or other_id in recompute or post_id not in entry:
+                continue
+            score = scores.get(post_id)
+            if score is not None and (score >= entry[post_id] or len(entry) < corpus.count):
+                entry[post_id] = score
+                lists[other_id] = None
+            elif score is None and len(entry) < corpus.count:
+                del entry[post_id]
+                lists[other_id] = None
+            else:
+                # the post dropped; a candidate outside the list may take its place
+                recompute.add(other_id)
+        for other_id, score in scores.iteritems():
+            if other_id in queued or other_id in recompute:
+                continue
+            entry = current.setdefault(other_id, {})
+            if post_id in entry:
+                continue
+            if len(entry) < corpus.count or score > min(entry.itervalues()):
+                entry[post_id] = score
+                if len(entry) > corpus.count:
+                    del entry[min(entry, key=entry.get)]
+                lists[other_id] = None
+
+    others = Post.objects.filter(pk__in=recompute - queued).values_list('id', 'title', 'text')
+    for post_id, title, text in others:
+        lists[post_id] = corpus.top(corpus.post_scores(post_id, title, text))
+    for post_id, top in lists.items():
+        if top is None:
+            lists[post_id] = sorted(((score, related_id) for related_id, score
+                                     in current[post_id].iteritems()), reverse=True)
+
+    RelatedPost.objects.filter(post__in=lists.keys()).delete()
+    rows = []
+    for post_id, top in lists.iteritems():
+        rows.extend(entries(post_id, top))
+    RelatedPost.objects.bulk_create(rows, batch_size=500)
+    RelatedPostsUpdate.objects.filter(post__in=queued).delete()
+    bump_generation(RELATED_GENERATION)
+    return len(lists)
+
+
+def related_posts(post, statuses):
+    """
+    The related posts of a post, best first.
+    """
+    return [entry.related for entry in RelatedPost.objects.filter(
+        post=post, related__status__in=statuses
+    ).select_related('related').defer('related__text').order_by('rank')]
+
+
+def queue_update(post_id):
+    RelatedPostsUpdate.objects.get_or_create(post_id=post_id)
+
+
+def post_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        queue_update(instance.pk)
+
+
+def post_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        queue_update(instance.pk)
+    elif pk_set:
+        for post_id in pk_set:
+            queue_update(post_id)
+
+
+def post_deleting(sender, instance, **kwargs):
+    # the lists the post appears in lose an entry
+    for post_id in RelatedPost.objects.filter(related=instance).values_list('post', flat=True):
+        if post_id != instance.pk:
+            queue_update(post_id)
+
+
+post_save.connect(post_saved, sender=Post, dispatch_uid='metablog.related.post_saved')
+pre_delete.connect(post_deleting, sender=Post, dispatch_uid='metablog.related.post_deleting')
+m2m_changed.connect(post_tags_changed, sender=Post.tags.through,
+                    dispatch_uid='metablog.related.post_tags_changed')
@@ -0,0 +1,461 @@
+"""@package docstring
+Full-text search over posts.
+
+The backend is chosen by CK_METABLOG_SEARCH_BACKEND:
+
+  'index'       an inverted index (SearchPosting) mapping terms to posts with
+                a weight built from the fields a term appears in and the
+                post's search_priority.
+  'sqlite'      an FTS5 virtual table, metablog_post_fts.
+  'postgresql'  a weighted tsvector column on metablog_post with a GIN index.
+
+Every backend is updated from save signals and rebuilt by the
+rebuild_search_index command.  Migration 0020 creates the FTS5 table and the
+tsvector column and index, so saving a post never runs DDL; the command
+creates them too, for databases migrated before they were available.  Searches narrow an
+ordinary Post queryset, so results follow the same status rules as the rest
+of the views.  The inverted index ranks matches with one grouped query over
+the postings and loads the posts of a page only.
+"""
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
+from django.db.models import Count, Sum
+from django.db.models.signals import post_save, pre_delete, post_delete, m2m_changed
+
+from models import Post, Tag, SearchPosting
+from excerpts import plain_text
+
+from math import log
+from multiprocessing import Pool
+import re
+
+
+re_term = re.compile(r'\w+', re.UNICODE)
+
+MAX_TERM_LENGTH = 32
+
+STOP_WORDS = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'from',
+    'has', 'have', 'i', 'if', 'in', 'into', 'is', 'it', 'its', 'of', 'on',
+    'or', 'our', 'so', 'that', 'the', 'their', 'then', 'there', 'these',
+    'they', 'this', 'to', 'was', 'we', 'were', 'will', 'with', 'you',
+))
+
+# Weight of a term occurrence by the field it appears in.
+FIELD_WEIGHTS = (
+    ('title', 4.0),
+    ('tags', 3.0),
+    ('description', 2.0),
+    ('text', 1.0),
+)
+
+PRIORITY_BOOSTS = {
+    Post.NORMAL: 1.0,
+    Post.PREFERRED: 1.5,
+    Post.HIGHLIGHTED: 2.0,
+}
+
+
+def tokenize(text):
+    """
+    Lower-cased search terms of a plain text string, without stop words.
+    """
+    terms = []
+    for term in re_term.findall(text.lower()):
+        if len(term) > 1 and term not in STOP_WORDS:
+            terms.append(term[:MAX_TERM_LENGTH])
+    return terms
+
+
+def post_document(post, tag_names=None):
+    """
+    The indexed fields of a post as a picklable dictionary.
+    """
+    if tag_names is None:
+        tag_names = [tag.name for tag in post.tags.all()]
+    return document(post.pk, post.title, post.description, tag_names, post.text,
+                    post.search_priority)
+
+
+def document(post_id, title, description, tag_names, text, search_priority):
+    return {
+        'id': post_id,
+        'title': title,
+        'description': description,
+        'tags': u' '.join(tag_names),
+        'text': text,
+        'search_priority': search_priority,
+    }
+
+
+def term_weights(document):
+    """
+    Returns (post id, {term: weight}) for a post_document().  Occurrences in
+    each field are damped logarithmically, and the total is scaled by the
+    post's search_priority.
+    """
+    weights = {}
+    for field, field_weight in FIELD_WEIGHTS:
+        text = document[field] or u''
+        if field == 'text':
+            text = plain_text(text)
+
+        counts = {}
+        for term in tokenize(text):
+            counts[term] = counts.get(term, 0) + 1
+        for term, count in counts.items():
+            weights[term] = weights.get(term, 0.0) + field_weight * (1.0 + log(count))
+
+    boost = PRIORITY_BOOSTS.get(document['search_priority'], 1.0)
+    for term in weights:
+        weights[term] *= boost
+    return document['id'], weights
+
+
+def post_tag_names():
+    """
+    Returns {post id: [tag name, ...]} for every tagged post.
+    """
+    tag_names = {}
+    through = Post.tags.through
+    for post_id, name in through.objects.values_list('post_id', 'tag__name').iterator():
+        tag_names.setdefault(post_id, []).append(name)
+    return tag_names
+
+
+def all_documents(tag_names):
+    # plain rows: Post instances would load their deferred fields one by one
+    posts = Post.objects.values_list('id', 'title', 'description', 'text', 'search_priority')
+    for post_id, title, description, text, search_priority in posts.iterator():
+        yield document(post_id, title, description, tag_names.get(post_id, []), text,
+                       search_priority)
+
+
+def document_chunks(tag_names, chunk_size):
+    """
+    all_documents() in lists of chunk_size, read by the calling thread.
+    """
+    chunk = []
+    for document in all_documents(tag_names):
+        chunk.append(document)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def priority_boost_sql(column):
+    """
+    SQL expression for the PRIORITY_BOOSTS factor of a search_priority column.
+    """
+    cases = ' '.join('WHEN %d THEN %r' % (priority, boost)
+                     for priority, boost in sorted(PRIORITY_BOOSTS.items()))
+    return '(CASE %s %s ELSE 1.0 END)' % (column, cases)
+
+
+def post_column(name):
+    qn = connection.ops.quote_name
+    return '%s.%s' % (qn(Post._meta.db_table), qn(name))
+
+
+class InvertedIndexBackend(object):
+    """
+    Search through the SearchPosting table.
+    """
+
+    def install(self):
+        pass
+
+    def postings(self, post_id, weights):
+        return [SearchPosting(term=term, post_id=post_id, weight=weight)
+                for term, weight in weights.items()]
+
+    def index_post(self, post):
+        post_id, weights = term_weights(post_document(post))
+        SearchPosting.objects.filter(post=post_id).delete()
+        SearchPosting.objects.bulk_create(self.postings(post_id, weights))
+
+    def remove_post(self, post_id):
+        # postings are deleted along with their post
+        pass
+
+    def rebuild(self, processes=None, chunk_size=500):
+        """
+        Recreates the whole index.  Documents are tokenized in parallel by a
+        process pool while this process reads posts and writes postings.
+        Returns the number of posts indexed.
+        """
+        # fork the workers before touching the database; they only tokenize.
+        pool = Pool(processes)
+        try:
+            SearchPosting.objects.all().delete()
+
+            count = 0
+            # rows are read here, in the caller's transaction, and handed to
+            # the pool as plain lists: an iterator would be consumed by the
+            # pool's own thread, on a connection of its own.
+            for documents in document_chunks(post_tag_names(), chunk_size):
+                batch = []
+                for post_id, weights in pool.map(term_weights, documents):
+                    batch.extend(self.postings(post_id, weights))
+                SearchPosting.objects.bulk_create(batch, batch_size=chunk_size)
+                count += len(documents)
+        finally:
+            pool.close()
+            pool.join()
+        return count
+
+    def search(self, terms, posts):
+        ranking = SearchPosting.objects.filter(
+            term__in=terms, post__in=posts.order_by().values('id')
+        ).values('post').annotate(
+            search_matches=Count('id'), search_score=Sum('weight')
+        ).order_by('-search_matches', '-search_score', '-post__post_date', '-post')
+        return RankedPosts(ranking, posts)
+
+
+class RankedPosts(object):
+    """
+    The posts of a ranking query, a values() queryset with a 'post' column,
+    in its order.  Only the count() and the posts of the slices taken are
+    read, as cull_posts pages a listing.
+    """
+    def __init__(self, ranking, posts):
+        self.ranking = ranking
+        self.posts = posts
+
+    def count(self):
+        return self.ranking.count()
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        ids = [row['post'] for row in self.ranking[index]]
+        found = self.posts.in_bulk(ids)
+        return [found[post_id] for post_id in ids if post_id in found]
+
+
+class DatabaseBackend(object):
+    """
+    Base of the backends that leave matching and ranking to the database.
+    Documents are stored with their text stripped of HTML.
+    """
+
+    def index_post(self, post):
+        self.store([post_document(post)])
+
+    def rebuild(self, processes=None, chunk_size=500):
+        self.install()
+        self.clear()
+        count = 0
+        batch = []
+        for document in all_documents(post_tag_names()):
+            batch.append(document)
+            if len(batch) >= chunk_size:
+                self.store(batch)
+                count += len(batch)
+                batch = []
+        self.store(batch)
+        return count + len(batch)
+
+    def fields(self, document):
+        return (document['title'], document['tags'], document['description'] or u'',
+                plain_text(document['text'] or u''))
+
+
+class SqliteFts5Backend(DatabaseBackend):
+    """
+    Search through an FTS5 virtual table keyed by post id, ranked by bm25
+    with the same field weights as the inverted index.
+    """
+    table = 'metablog_post_fts'
+
+    def install(self):
+        connection.cursor().execute(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(title, tags, description, text)'
+            % self.table)
+
+    def clear(self):
+        connection.cursor().execute('DELETE FROM %s' % self.table)
+
+    def store(self, documents):
+        if not documents:
+            return
+        cursor = connection.cursor()
+        cursor.executemany('DELETE FROM %s WHERE rowid = %%s' % self.table,
+                           [(document['id'],) for document in documents])
+        cursor.executemany(
+            'INSERT INTO %s (rowid, title, tags, description, text) VALUES (%%s, %%s, %%s, %%s, %%s)'
+            % self.table,
+            [(document['id'],) + self.fields(document) for document in documents])
+
+    def remove_post(self, post_id):
+        connection.cursor().execute('DELETE FROM %s WHERE rowid = %%s' % self.table, [post_id])
+
+    def search(self, terms, posts):
+        match = ' OR '.join('"%s"' % term for term in terms)
+        weights = ', '.join('%r' % weight for field, weight in FIELD_WEIGHTS)
+        rank = ('SELECT -bm25(%s, %s) * %s FROM %s WHERE %s MATCH %%s AND rowid = %s' % (
+            self.table, weights, priority_boost_sql(post_column('search_priority')),
+            self.table, self.table, post_column('id')))
+
+        return posts.extra(
+            select={'search_score': rank},
+            select_params=[match],
+            where=['%s IN (SELECT rowid FROM %s WHERE %s MATCH %%s)' % (
+                post_column('id'), self.table, self.table)],
+            params=[match]
+        ).order_by('-search_score', '-post_date')
+
+
+class PostgresqlBackend(DatabaseBackend):
+    """
+    Search through a tsvector column of metablog_post with a GIN index.
+    Title, tags, description and text are weighted A to D.
+    """
+    column = 'search_vector'
+    index = 'metablog_post_search_vector'
+
+    def text_search_config(self):
+        return getattr(settings, 'CK_METABLOG_SEARCH_CONFIG', 'english')
+
+    def install(self):
+        table = Post._meta.db_table
+        cursor = connection.cursor()
+        cursor.execute('ALTER TABLE %s ADD COLUMN IF NOT EXISTS %s tsvector' % (table, self.column))
+        cursor.execute('CREATE INDEX IF NOT EXISTS %s ON %s USING gin(%s)'
+                       % (self.index, table, self.column))
+
+    def clear(self):
+        connection.cursor().execute('UPDATE %s SET %s = NULL' % (Post._meta.db_table, self.column))
+
+    def store(self, documents):
+        if not documents:
+            return
+        config = self.text_search_config()
+        vector = ' || '.join("setweight(to_tsvector(%%s, %%s), '%s')" % weight for weight in 'ABCD')
+        params = []
+        for document in documents:
+            row = []
+            for field in self.fields(document):
+                row.extend((config, field))
+            params.append(row + [document['id']])
+        connection.cursor().executemany(
+            'UPDATE %s SET %s = %s WHERE id = %%s' % (Post._meta.db_table, self.column, vector),
+            params)
+
+    def remove_post(self, post_id):
+        # the vector is deleted along with its post
+        pass
+
+    def search(self, terms, posts):
+        config = self.text_search_config()
+        query = ' | '.join(terms)
+        column = '%s.%s' % (connection.ops.quote_name(Post._meta.db_table), self.column)
+        return posts.extra(
+            select={'search_score': 'ts_rank(%s, to_tsquery(%%s, %%s)) * %s' % (
+                column, priority_boost_sql(post_column('search_priority')))},
+            select_params=[config, query],
+            where=['%s @@ to_tsquery(%%s, %%s)' % column],
+            params=[config, query]
+        ).order_by('-search_score', '-post_date')
+
+
+# CK_METABLOG_SEARCH_BACKEND -> backend class
+BACKENDS = {
+    'index': InvertedIndexBackend,
+    'sqlite': SqliteFts5Backend,
+    'postgresql': PostgresqlBackend,
+}
+
+
+def get_backend():
+    name = getattr(settings, 'CK_METABLOG_SEARCH_BACKEND', 'index')
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise ImproperlyConfigured("Unknown CK_METABLOG_SEARCH_BACKEND '%s'" % name)
+
+
+@transaction.commit_on_success
+def rebuild_index(processes=None):
+    """
+    Installs and refills the configured backend.  Returns the number of posts
+    indexed.
+    """
+    return get_backend().rebuild(processes)
+
+
+def search_posts(query, posts):
+    """
+    Narrows a Post queryset (such as one from Post.query) to posts matching
+    any term of the query, most relevant first.
+    """
+    terms = list(set(tokenize(query)))
+    if not terms:
+        return posts.none()
+    return get_backend().search(terms, posts)
+
+
+def post_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        get_backend().index_post(instance)
+
+
+def post_deleted(sender, instance, **kwargs):
+    get_backend().remove_post(instance.pk)
+
+
+def index_posts(post_ids):
+    backend = get_backend()
+    for post in Post.objects.filter(pk__in=post_ids):
+        backend.index_post(post)
+
+
+def post_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == 'pre_clear':
+        # pk_set is None when a tag is cleared; note its posts first
+        instance._search_post_ids = list(instance.post_set.values_list('id', flat=True))
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        get_backend().index_post(instance)
+    elif action == 'post_clear':
+        index_posts(getattr(instance, '_search_post_ids', []))
+    elif pk_set:
+        index_posts(pk_set)
+
+
+def tag_saved(sender, instance, created, raw=False, **kwargs):
+    if raw or created:
+        return
+    backend = get_backend()
+    for post in instance.post_set.all():
+        backend.index_post(post)
+
+
+def tag_deleting(sender, instance, **kwargs):
+    instance._search_post_ids = list(instance.post_set.values_list('id', flat=True))
+
+
+def tag_deleted(sender, instance, **kwargs):
+    # the delete removed the tag from its posts without an m2m_changed signal
+    index_posts(getattr(instance, '_search_post_ids', []))
+
+
+post_save.connect(post_saved, sender=Post, dispatch_uid='metablog.search.post_saved')
+post_delete.connect(post_deleted, sender=Post, dispatch_uid='metablog.search.post_deleted')
+post_save.connect(tag_saved, sender=Tag, dispatch_uid='metablog.search.tag_saved')
+pre_delete.connect(tag_deleting, sender=Tag, dispatch_uid='metablog.search.tag_deleting')
+post_delete.connect(tag_deleted, sender=Tag, dispatch_uid='metablog.search.tag_deleted')
+m2m_changed.connect(post_tags_changed, sender=Post.tags.through,
+                    dispatch_uid='metablog.search.post_tags_changed')
@@ -0,0 +1,61 @@
+"""@package docstring
+Cached sidebar data shared by the Metablog views.
+
+Categories, the archive tree and the blogroll change a few times a week, so
+they are cached per status set (public/admin) and invalidated by bumping a
+generation counter whenever a Post, Category, Tag or Link is saved or deleted.
+"""
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+
+from models import Post, Category, Tag, Link
+from archive_tree import get_archive_tree
+from caching import GenerationCache
+
+
+sidebar_cache = GenerationCache(
+    'sidebar', getattr(settings, 'CK_METABLOG_SIDEBAR_CACHE_TIMEOUT', 60 * 60 * 24))
+
+
+def build_sidebar(is_admin):
+    """
+    Returns (categories, archives, blogroll) for public or admin visitors.
+    """
+    categories = list(Category.objects.select_related('tag'))
+
+    archives = get_archive_tree(is_admin).as_dict()
+    blogroll = None
+    try:
+        favorites_tag = Tag.objects.get(slug='favorite-blog')
+    except:
+        favorites_tag = None
+
+    if favorites_tag:
+        blogroll = list(Link.objects.filter(tag__exact=favorites_tag).order_by('rank'))
+
+    return categories, archives, blogroll
+
+
+def get_sidebar(is_admin):
+    return sidebar_cache.get('admin' if is_admin else 'public',
+                             lambda: build_sidebar(is_admin))
+
+
+def sidebar_stats():
+    """
+    Generation and per-process hit/miss counts of the sidebar cache.
+    """
+    return sidebar_cache.stats()
+
+
+def invalidate_sidebar(sender, raw=False, **kwargs):
+    if not raw:
+        sidebar_cache.invalidate()
+
+
+for model in (Post, Category, Tag, Link):
+    post_save.connect(invalidate_sidebar, sender=model,
+                      dispatch_uid='metablog.sidebar.saved.%s' % model.__name__)
+    post_delete.connect(invalidate_sidebar, sender=model,
+                        dispatch_uid='metablog.sidebar.deleted.%s' % model.__name__)
@@ -0,0 +1,216 @@
+"""@package docstring
+XML sitemap of the public blog, split into shards.
+
+The sitemap index lists a 'pages' sitemap (the home page, categories and
+archive years and months) and one sitemap per shard of articles.  Shard n
+holds the visible posts with ids from n * CK_METABLOG_SITEMAP_SHARD_SIZE
+(at most 50000, the protocol's limit) up to the next shard, so a post never
+moves between shards.  Articles carry their modified_date as lastmod and a
+priority from their search_priority.
+
+Each sitemap is written as a stream on a miss and the finished document,
+with its compressed variants, is cached under a generation of its own.
+Saving or deleting a post bumps only its shard's generation, plus those of
+the index and 'pages' sitemap when it enters or leaves the public listing.
+"""
+
+from django.conf import settings
+from django.contrib.sites.models import get_current_site
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.db.models.signals import post_save, post_delete
+from django.http import Http404, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.feedgenerator import rfc3339_date
+from django.utils.xmlutils import SimplerXMLGenerator
+
+from models import Post, Category, Tag
+from archive_tree import get_archive_tree
+from caching import get_generation, bump_generation
+from compression import compress_variants, variant_response
+from feeds import StreamBuffer
+from taxonomy import all_categories
+from urlbuilder import build_url, article_url, archive_year_url, archive_month_url
+
+from hashlib import md5
+
+
+SITEMAP_NS = u'http://www.sitemaps.org/schemas/sitemap/0.9'
+
+SITEMAP_KEY = 'metablog:sitemap:%s:%s:%d'
+
+INDEX_GENERATION = 'sitemap:index'
+PAGES_GENERATION = 'sitemap:pages'
+
+# Entries written between stream chunks.
+CHUNK_ENTRIES = 500
+
+PRIORITIES = {
+    Post.NORMAL: u'0.5',
+    Post.PREFERRED: u'0.7',
+    Post.HIGHLIGHTED: u'0.9',
+}
+
+
+def shard_size():
+    return min(getattr(settings, 'CK_METABLOG_SITEMAP_SHARD_SIZE', 50000), 50000)
+
+
+def _cache_timeout():
+    return getattr(settings, 'CK_METABLOG_SITEMAP_CACHE_TIMEOUT', 60 * 60 * 24)
+
+
+def shard_generation(shard):
+    return 'sitemap:posts:%d' % shard
+
+
+def shard_posts(shard):
+    size = shard_size()
+    return Post.objects.filter(status__in=Post.visible_statuses(False),
+                               id__gte=shard * size, id__lt=(shard + 1) * size)
+
+
+def post_shards():
+    """
+    The shards holding at least one visible post, in order, found by the
+    database in one grouped query.
+    """
+    size = shard_size()
+    shards = Post.objects.filter(status__in=Post.visible_statuses(False)).extra(
+        select={'shard': '(id - id %% %s) / %s'}, select_params=(size, size)
+    ).order_by('shard').values_list('shard', flat=True).distinct()
+    return [int(shard) for shard in shards]
+
+
+def write_sitemap(root, entries):
+    """
+    Yields a <urlset> or <sitemapindex> document in chunks.  entries are
+    (loc, lastmod, priority) tuples; lastmod and priority may be None.
+    """
+    buffer = StreamBuffer()
+    handler = SimplerXMLGenerator(buffer, 'utf-8')
+    element = u'url' if root == u'urlset' else u'sitemap'
+    handler.startDocument()
+    handler.startElement(root, {u'xmlns': SITEMAP_NS})
+    for count, (loc, lastmod, priority) in enumerate(entries, 1):
+        handler.startElement(element, {})
+        handler.addQuickElement(u'loc', loc)
+        if lastmod is not None:
+            handler.addQuickElement(u'lastmod', rfc3339_date(lastmod).decode('utf-8'))
+        if priority is not None:
+            handler.addQuickElement(u'priority', priority)
+        handler.endElement(element)
+        if count % CHUNK_ENTRIES == 0:
+            yield buffer.drain()
+    handler.endElement(root)
+    yield buffer.drain()
+
+
+def index_entries(base):
+    yield base + reverse('metablog_sitemap_pages'), None, None
+    for shard in post_shards():
+        yield base + build_url('metablog_sitemap_posts', shard=shard), None, None
+
+
+def page_entries(base):
+    yield base + reverse('metablog_home'), None, None
+    for category in all_categories():
+        yield base + category.get_absolute_url(), None, None
+    tree = get_archive_tree(False).as_dict() or {'archives': []}
+    for year in tree['archives']:
+        yield base + archive_year_url(year['year']), None, None
+        for month in year['archives']:
+            yield base + archive_month_url(year['year'], month['month']), None, None
+
+
+def post_entries(base, shard):
+    posts = shard_posts(shard).order_by('id').values_list('slug', 'modified_date', 'search_priority')
+    for slug, modified_date, search_priority in posts.iterator():
+        yield base + article_url(slug), modified_date, PRIORITIES.get(search_priority)
+
+
+def sitemap_entry(content):
+    return {
+        'content': content,
+        'variants': compress_variants(content),
+        'etag': md5(content).hexdigest(),
+        'last_modified': timezone.now().replace(microsecond=0),
+    }
+
+
+def sitemap_response(request, name, generation_name, root, entries, found=None):
+    """
+    Serves a sitemap from the cache, or streams it with entries(base URL)
+    and caches the finished document.  On a miss, found() (if given) says
+    whether the sitemap exists at all.
+    """
+    scheme = 'https' if request.is_secure() else 'http'
+    key = SITEMAP_KEY % (name, scheme, get_generation(generation_name))
+    entry = cache.get(key)
+    if entry is not None:
+        return variant_response(request, entry['content'], entry['variants'],
+                                'application/xml', entry['etag'], entry['last_modified'])
+    if found is not None and not found():
+        raise Http404
+
+    base = '%s://%s' % (scheme, get_current_site(request).domain)
+
+    def stream():
+        parts = []
+        for chunk in write_sitemap(root, entries(base)):
+            parts.append(chunk)
+            yield chunk
+        cache.set(key, sitemap_entry(''.join(parts)), _cache_timeout())
+
+    return StreamingHttpResponse(stream(), content_type='application/xml')
+
+
+def sitemap_index(request):
+    return sitemap_response(request, 'index', INDEX_GENERATION, u'sitemapindex', index_entries)
+
+
+def sitemap_pages(request):
+    return sitemap_response(request, 'pages', PAGES_GENERATION, u'urlset', page_entries)
+
+
+def sitemap_posts(request, shard):
+    shard = int(shard)
+    return sitemap_response(request, 'posts-%d' % shard, shard_generation(shard), u'urlset',
+                            lambda base: post_entries(base, shard),
+                            lambda: shard_posts(shard).exists())
+
+
+def post_saved(sender, instance, created=False, raw=False, **kwargs):
+    if raw:
+        return
+    bump_generation(shard_generation(instance.pk // shard_size()))
+    visible = Post.visible_statuses(False)
+    was_visible = not created and instance._original_status in visible
+    if (instance.status in visible) != was_visible:
+        bump_generation(INDEX_GENERATION)
+        bump_generation(PAGES_GENERATION)
+    elif was_visible and instance.post_date != instance._original_post_date:
+        # it may open or close an archive month
+        bump_generation(PAGES_GENERATION)
+
+
+def post_deleted(sender, instance, **kwargs):
+    bump_generation(shard_generation(instance.pk // shard_size()))
+    if instance.status in Post.visible_statuses(False):
+        bump_generation(INDEX_GENERATION)
+        bump_generation(PAGES_GENERATION)
+
+
+def invalidate_pages(sender, raw=False, **kwargs):
+    if not raw:
+        bump_generation(PAGES_GENERATION)
+
+
+post_save.connect(post_saved, sender=Post, dispatch_uid='metablog.sitemap.post_saved')
+post_delete.connect(post_deleted, sender=Post, dispatch_uid='metablog.sitemap.post_deleted')
+
+for model in (Category, Tag):
+    post_save.connect(invalidate_pages, sender=model,
+                      dispatch_uid='metablog.sitemap.saved.%s' % model.__name__)
+    post_delete.connect(invalidate_pages, sender=model,
+                        dispatch_uid='metablog.sitemap.deleted.%s' % model.__name__)
@@ -0,0 +1,336 @@
+"""@package docstring
+Static copy of the public blog, for serving from files during traffic spikes.
+
+export_site() renders every public page of metablog/urls.py the way an
+anonymous visitor sees it: the home and category listings at every start=
+step, the year and month archives, every article and every RSS, Atom and
+JSON feed with its archive pages.  Pages are rendered through the full
+request stack by a pool of worker processes.
+
+A page's file is <path>/index.<ext>, or <path>/index-start-<N>.<ext> for
+later steps of a listing (for the web server to map ?start=N to), with the
+extension following its content type.
+
+The export directory holds a manifest.json recording, for each page, its
+file, the md5 of its content and the posts it shows.  A later run renders
+again only the pages that show a post modified since the last export, whose
+list of posts changed, or, for HTML pages, whose sidebar (archive tree,
+categories and blogroll) changed; the other files, and re-rendered pages
+whose content hash is unchanged, are hard-linked from the previous export.
+Each export goes to a new directory, and the output path is a symlink that
+is switched to it with a single rename, so the web server never sees a
+partial export.
+"""
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.urlresolvers import reverse
+from django.test.client import Client
+from django.utils import timezone
+
+from models import Post, Tag, Category, Link, RelatedPost
+from archive_tree import get_archive_tree
+from taxonomy import all_categories
+from feeds import archive_page_size
+from websub import FEED_NAMES
+from urlbuilder import article_url
+
+from calendar import timegm
+from datetime import datetime
+from hashlib import md5
+from multiprocessing import Pool
+from time import mktime
+import json
+import os
+import shutil
+import tempfile
+
+
+MANIFEST_NAME = 'manifest.json'
+
+CONTENT_EXTENSIONS = {
+    'text/html': 'html',
+    'application/rss+xml': 'xml',
+    'application/atom+xml': 'xml',
+    'application/feed+json': 'json',
+    'application/json': 'json',
+}
+
+
+class ExportError(Exception):
+    pass
+
+
+class Page(object):
+    """
+    A URL to export, with the ids of the posts it shows.
+    """
+    def __init__(self, path, post_ids, start=0, feed=False):
+        self.path = path
+        self.post_ids = post_ids
+        self.start = start
+        self.feed = feed
+
+    @property
+    def key(self):
+        if self.start:
+            return '%s?start=%d' % (self.path, self.start)
+        return self.path
+
+    def filename(self, content_type):
+        extension = CONTENT_EXTENSIONS.get(content_type.split(';')[0].strip(), 'html')
+        name = 'index-start-%d.%s' % (self.start, extension) if self.start else 'index.%s' % extension
+        return os.path.join(self.path.lstrip('/'), name)
+
+
+def listing_pages(path, post_ids):
+    """
+    The start= steps of a post listing, as cull_posts pages it.
+    """
+    page_size = settings.CK_METABLOG_PER_PAGE_COUNT
+    pages = [Page(path, post_ids[:page_size])]
+    for start in range(page_size, len(post_ids), page_size):
+        pages.append(Page(path, post_ids[start:start + page_size], start))
+    return pages
+
+
+def feed_pages(category, post_ids):
+    """
+    The subscription feeds and archive pages of a listing, as FeedPage
+    divides it.
+    """
+    kwargs = {}
+    prefix = ''
+    if category is not None:
+        kwargs['category_slug'] = category.tag.slug
+        prefix = 'category-'
+
+    page_size = archive_page_size()
+    archived_pages = len(post_ids) // page_size
+    latest = post_ids[:max(len(post_ids) - archived_pages * page_size, 10)]
+    oldest_first = post_ids[::-1]
+
+    pages = []
+    for feed_name in FEED_NAMES:
+        pages.append(Page(reverse('%s-%slatest' % (feed_name, prefix), kwargs=kwargs),
+                          latest, feed=True))
+        for page in range(1, archived_pages + 1):
+            page_kwargs = dict(kwargs, page=page)
+            pages.append(Page(reverse('%s-%sarchive' % (feed_name, prefix), kwargs=page_kwargs),
+                              oldest_first[(page - 1) * page_size:page * page_size], feed=True))
+    return pages
+
+
+def site_pages():
+    """
+    Every page of the public blog.
+    """
+    statuses = Post.visible_statuses(False)
+
+    def listing(tags=None, year=0, month=0):
+        return list(Post.query(statuses, tags, year, month).values_list('id', flat=True))
+
+    posts = listing()
+    pages = listing_pages(reverse('metablog_home'), posts)
+    pages.extend(feed_pages(None, posts))
+
+    for category in all_categories():
+        posts = listing([category.tag])
+        pages.extend(listing_pages(category.get_absolute_url(), posts))
+        pages.extend(feed_pages(category, posts))
+
+    tree = get_archive_tree(False).as_dict() or {'archives': []}
+    for year in tree['archives']:
+        pages.extend(listing_pages(reverse('metablog_archive_year', kwargs={'year': year['year']}),
+                                   listing(None, year['year'])))
+        for month in year['archives']:
+            path = reverse('metablog_archive_year_month',
+                           kwargs={'year': year['year'], 'month': month['month']})
+            pages.extend(listing_pages(path, listing(None, year['year'], month['month'])))
+
+    related = {}
+    for post_id, related_id in RelatedPost.objects.filter(
+        related__status__in=statuses
+    ).order_by('post', 'rank').values_list('post', 'related'):
+        related.setdefault(post_id, []).append(related_id)
+
+    articles = Post.objects.filter(status__in=statuses).values_list(
+        'id', 'slug', 'prev_post', 'next_post')
+    for post_id, slug, prev_id, next_id in articles.iterator():
+        pages.append(Page(article_url(slug),
+                          [post_id, prev_id, next_id] + related.get(post_id, [])))
+    return pages
+
+
+def fingerprint(*parts):
+    return md5(repr(parts)).hexdigest()
+
+
+def site_fingerprints():
+    """
+    Hashes of what every feed ('taxonomy') and every HTML page ('sidebar')
+    shows besides its posts.
+    """
+    taxonomy = fingerprint(list(Tag.objects.order_by('id').values_list()),
+                           list(Category.objects.order_by('id').values_list()))
+    archives = json.dumps(get_archive_tree(False).as_dict(), default=unicode, sort_keys=True)
+    sidebar = fingerprint(taxonomy, list(Link.objects.order_by('id').values_list()), archives)
+    return {'taxonomy': taxonomy, 'sidebar': sidebar}
+
+
+def stale_pages(pages, manifest, changed_post_ids, fingerprints):
+    """
+    The pages that must be rendered again, given the manifest of the last
+    export and the ids of the posts modified since.
+    """
+    entries = manifest.get('pages', {})
+    sidebar_changed = fingerprints['sidebar'] != manifest.get('sidebar')
+    taxonomy_changed = fingerprints['taxonomy'] != manifest.get('taxonomy')
+
+    stale = []
+    for page in pages:
+        entry = entries.get(page.key)
+        if (entry is None or entry['posts'] != page.post_ids
+                or changed_post_ids.intersection(page.post_ids)
+                or (taxonomy_changed if page.feed else sidebar_changed)):
+            stale.append(page)
+    return stale
+
+
+def _timestamp(value):
+    if timezone.is_aware(value):
+        return timegm(value.utctimetuple())
+    return int(mktime(value.timetuple()))
+
+
+def _from_timestamp(timestamp):
+    if settings.USE_TZ:
+        return timezone.make_aware(datetime.utcfromtimestamp(timestamp), timezone.utc)
+    return datetime.fromtimestamp(timestamp)
+
+
+def read_manifest(output):
+    try:
+        with open(os.path.join(output, MANIFEST_NAME)) as manifest_file:
+            return json.load(manifest_file)
+    except (IOError, ValueError):
+        return {}
+
+
+_client = None
+
+
+def render_page(task):
+    """
+    Renders one page in a worker process.  Returns (key, status code,
+    content type, content).
+    """
+    global _client
+    key, path, start, host = task
+    if _client is None:
+        _client = Client(HTTP_HOST=host)
+    response = _client.get(path, {'start': start} if start else {})
+    if response.streaming:
+        content = ''.join(response.streaming_content)
+    else:
+        content = response.content
+    return key, response.status_code, response['Content-Type'], content
+
+
+def _link(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def _write(directory, filename, content=None, source=None):
+    destination = os.path.join(directory, filename)
+    parent = os.path.dirname(destination)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    if source is not None:
+        _link(source, destination)
+    else:
+        with open(destination, 'wb') as page_file:
+            page_file.write(content)
+
+
+def export_site(output, processes=None, full=False):
+    """
+    Exports the public blog to output, a symlink to the latest export
+    directory, rendering again only the pages changed since the last export
+    unless full is set.  Returns (pages, rendered, written): the number of
+    pages exported, rendered and found changed.
+    """
+    output = output.rstrip(os.sep)
+    if os.path.lexists(output) and not os.path.islink(output):
+        raise ExportError("%s exists and is not a symlink to an export" % output)
+    previous = os.path.realpath(output) if os.path.islink(output) else None
+
+    # fork the workers before touching the database; each opens its own
+    # connection.
+    pool = Pool(processes)
+    try:
+        started = timezone.now()
+        manifest = {} if full or previous is None else read_manifest(previous)
+        changed_post_ids = set()
+        if 'exported' in manifest:
+            changed_post_ids = set(Post.objects.filter(
+                modified_date__gte=_from_timestamp(manifest['exported'])
+            ).values_list('id', flat=True))
+
+        fingerprints = site_fingerprints()
+        pages = site_pages()
+        stale = stale_pages(pages, manifest, changed_post_ids, fingerprints)
+
+        directory = tempfile.mkdtemp(prefix=os.path.basename(output) + '.',
+                                     dir=os.path.dirname(os.path.abspath(output)))
+        os.chmod(directory, 0755)
+        entries = {}
+        old_entries = manifest.get('pages', {})
+        written = 0
+        failed = []
+
+        host = Site.objects.get_current().domain
+        by_key = dict((page.key, page) for page in pages)
+        tasks = [(page.key, page.path, page.start, host) for page in stale]
+        for key, status, content_type, content in pool.imap_unordered(render_page, tasks, 8):
+            if status != 200:
+                failed.append('%s (%d)' % (key, status))
+                continue
+            page = by_key[key]
+            digest = md5(content).hexdigest()
+            old = old_entries.get(key)
+            if old is not None and old['hash'] == digest:
+                _write(directory, old['file'], source=os.path.join(previous, old['file']))
+            else:
+                _write(directory, page.filename(content_type), content)
+                written += 1
+            entries[key] = {'file': page.filename(content_type), 'hash': digest,
+                            'posts': page.post_ids}
+    finally:
+        pool.close()
+        pool.join()
+
+    if failed:
+        shutil.rmtree(directory)
+        raise ExportError("Could not render %s" % ', '.join(sorted(failed)))
+
+    for page in pages:
+        if page.key not in entries:
+            entry = old_entries[page.key]
+            _write(directory, entry['file'], source=os.path.join(previous, entry['file']))
+            entries[page.key] = entry
+
+    manifest = dict(fingerprints, exported=_timestamp(started), pages=entries)
+    _write(directory, MANIFEST_NAME, json.dumps(manifest))
+
+    # switch the symlink in one rename
+    link = directory + '.link'
+    os.symlink(os.path.basename(directory), link)
+    os.rename(link, output)
+    if previous is not None and os.path.isdir(previous):
+        shutil.rmtree(previous)
+
+    return len(pages), len(stale), written
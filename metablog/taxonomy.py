@@ -0,0 +1,72 @@
+"""@package docstring
+Per-process slug index for categories and tags.
+
+Category pages and feeds resolve their URL slug through this index instead of
+scanning every Category.  The index is built once per process and rebuilt
+when the 'taxonomy' generation, bumped by Tag and Category changes, moves on.
+"""
+
+from django.db.models.signals import post_save, post_delete
+
+from models import Tag, Category
+from caching import get_generation, bump_generation
+
+
+TAXONOMY_GENERATION = 'taxonomy'
+
+
+class SlugIndex(object):
+    """
+    Maps slugs to their Category and Tag.  Where slugs repeat, the lowest
+    id wins.
+    """
+    def __init__(self, generation):
+        self.generation = generation
+        self.tags = {}
+        for tag in Tag.objects.order_by('-id'):
+            self.tags[tag.slug] = tag
+        self.categories = {}
+        for category in Category.objects.select_related('tag').order_by('-id'):
+            self.categories[category.tag.slug] = category
+        self.category_list = sorted(self.categories.values(), key=lambda category: category.id)
+
+
+_slug_index = None
+
+
+def get_slug_index():
+    global _slug_index
+    generation = get_generation(TAXONOMY_GENERATION)
+    slug_index = _slug_index
+    if slug_index is None or slug_index.generation != generation:
+        slug_index = SlugIndex(generation)
+        _slug_index = slug_index
+    return slug_index
+
+
+def resolve_slug(slug):
+    """
+    Returns (category, tag) for a category or tag slug.  category is None for
+    a plain tag, and both are None if nothing matches.
+    """
+    slug_index = get_slug_index()
+    category = slug_index.categories.get(slug)
+    if category is not None:
+        return category, category.tag
+    return None, slug_index.tags.get(slug)
+
+
+def all_categories():
+    return get_slug_index().category_list
+
+
+def invalidate_taxonomy(sender, raw=False, **kwargs):
+    if not raw:
+        bump_generation(TAXONOMY_GENERATION)
+
+
+for model in (Tag, Category):
+    post_save.connect(invalidate_taxonomy, sender=model,
+                      dispatch_uid='metablog.taxonomy.saved.%s' % model.__name__)
+    post_delete.connect(invalidate_taxonomy, sender=model,
+                        dispatch_uid='metablog.taxonomy.deleted.%s' % model.__name__)
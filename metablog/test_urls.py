@@ -0,0 +1,7 @@
+"""@package docstring
+A URLconf that routes nothing, for tests of a site without a sitemap.
+"""
+
+from django.conf.urls.defaults import patterns
+
+urlpatterns = patterns('')
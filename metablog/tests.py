@@ -1,16 +1,1002 @@
-"""
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
+from datetime import datetime, timedelta
+import json
+import os
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+from urlparse import urlparse, parse_qs
+from gzip import GzipFile
+from StringIO import StringIO
+from base64 import urlsafe_b64encode
 
-Replace this with more appropriate tests for your application.
-"""
+from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.contrib.auth.models import User, AnonymousUser
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.core.signals import request_finished
+from django.core.urlresolvers import reverse, get_script_prefix, set_script_prefix
+from django.db import connection, transaction
+from django.http import Http404, HttpResponse
+from django.middleware.csrf import get_token
+from django.utils import timezone
 
-from django.test import TestCase
+from models import Post, Tag, Category, Link, Ping
+from archive_tree import get_archive_tree, create_post_archive, summarize_post_archive
+from archive_tree import archive_version_key
+from urlbuilder import build_url, article_url, site_url
+from websub import feed_urls, FEED_NAMES
+from sidebar import get_sidebar, sidebar_cache
+from taxonomy import resolve_slug, all_categories
+from pagination import cursor_page
+from ping_queue import process_pending_pings
+from search import search_posts, tokenize, rebuild_index
+from related import related_posts, rebuild_related_posts, refresh_related_posts
+from navigation import rebuild_post_chain
+from feed_cache import get_feed
+from feeds import FeedPage, ExtendedRSSFeed, JsonFeed
+from compression import accepted_encodings, compress_variants, encoded_response, variant_response
+from page_cache import cached_page, depends_on, post_generation
+from sitemap import post_shards
+from static_export import site_pages, site_fingerprints, stale_pages
+from views import archive_articles
+from excerpts import summarize, plain_text
 
 
-class SimpleTest(TestCase):
-    def test_basic_addition(self):
-        """
-        Tests that 1 + 1 always equals 2.
-        """
-        self.assertEqual(1 + 1, 2)
+# minimal home.html and post.html
+TEST_TEMPLATES = os.path.join(os.path.dirname(__file__), 'test_templates')
+
+
+def create_posts(count, author=None):
+    """
+    Creates count published posts 'post 0', 'post 1', ..., oldest first.
+    """
+    if author is None:
+        author = User.objects.create(username='author')
+    return [Post.objects.create(author=author, title='post %d' % index, slug='post-%d' % index,
+                                status=Post.PUBLISHED, text='')
+            for index in range(count)]
+
+
+class ExcerptTest(TestCase):
+
+    def test_excerpt_is_cut_at_a_word_with_balanced_tags(self):
+        excerpt, word_count, reading_time = summarize(
+            u'<p>One <b>two three</b> four</p><p>five six</p>', 2)
+        self.assertEqual(excerpt, u'<p>One <b>two ...</b></p>')
+        self.assertEqual(word_count, 6)
+        self.assertEqual(reading_time, 1)
+
+    def test_plain_text_and_reading_time(self):
+        self.assertEqual(plain_text(u'<p>A <a href="/">link</a>.</p>'), u'A link.')
+        self.assertEqual(summarize(u'', 10), (u'', 0, 0))
+
+        text = u'<p>%s</p>' % u' '.join([u'word'] * 401)
+        with self.settings(CK_METABLOG_WORDS_PER_MINUTE=200):
+            excerpt, word_count, reading_time = summarize(text, 500)
+        self.assertEqual(excerpt, text)
+        self.assertEqual((word_count, reading_time), (401, 3))
+
+
+################################################################################
+
+class ArchiveTreeTest(TestCase):
+    urls = 'cinekine.metablog.urls'
+
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create(username='author')
+
+    def create_post(self, slug, post_date, status=Post.PUBLISHED):
+        post = Post.objects.create(author=self.author, title=slug, slug=slug,
+                                   status=status, text='')
+        post.post_date = timezone.make_aware(post_date, timezone.utc)
+        post.save()
+        return post
+
+    def assertTreeMatchesDatabase(self, build=create_post_archive):
+        for is_admin in (False, True):
+            statuses = Post.visible_statuses(is_admin)
+            expected = build(Post.query(statuses))
+            self.assertEqual(get_archive_tree(is_admin).as_dict(), expected)
+
+    def test_signals_update_cached_tree(self):
+        get_archive_tree(False)
+        get_archive_tree(True)
+
+        first = self.create_post('first', datetime(2013, 1, 5))
+        second = self.create_post('second', datetime(2013, 3, 2))
+        draft = self.create_post('draft', datetime(2012, 7, 1), Post.DRAFT)
+        self.assertTreeMatchesDatabase()
+
+        # move to another year, retitle and hide.
+        first.post_date = timezone.make_aware(datetime(2014, 2, 1), timezone.utc)
+        first.title = 'moved'
+        first.save()
+        second.status = Post.HIDDEN
+        second.save()
+        self.assertTreeMatchesDatabase()
+
+        draft.delete()
+        first.delete()
+        self.assertTreeMatchesDatabase()
+        self.assertEqual(get_archive_tree(False).as_dict(), None)
+
+    def test_versions_follow_changes(self):
+        version = get_archive_tree(False).version
+        post = self.create_post('first', datetime(2013, 1, 5))
+        self.assertTrue(get_archive_tree(False).version > version)
+
+        version = get_archive_tree(False).version
+        post.text = 'edited'
+        post.save()
+        self.assertEqual(get_archive_tree(False).version, version)
+
+        # another handler took the next version and has not stored its tree
+        cache.incr(archive_version_key(False))
+        post.title = 'retitled'
+        post.save()
+        self.assertTreeMatchesDatabase()
+
+    @override_settings(CK_METABLOG_ARCHIVE_MODE='summary')
+    def test_signals_update_summary_counts(self):
+        get_archive_tree(False)
+        get_archive_tree(True)
+
+        first = self.create_post('first', datetime(2013, 1, 5))
+        self.create_post('second', datetime(2013, 1, 9))
+        self.create_post('draft', datetime(2012, 7, 1), Post.DRAFT)
+        self.assertTreeMatchesDatabase(summarize_post_archive)
+
+        first.post_date = timezone.make_aware(datetime(2013, 4, 1), timezone.utc)
+        first.save()
+        self.assertTreeMatchesDatabase(summarize_post_archive)
+
+        first.delete()
+        self.assertTreeMatchesDatabase(summarize_post_archive)
+
+    @override_settings(CK_METABLOG_ARCHIVE_MODE='summary', USE_TZ=True, TIME_ZONE='America/New_York')
+    def test_summary_counts_months_in_site_timezone(self):
+        get_archive_tree(False)
+        site_timezone = timezone.get_default_timezone()
+
+        # 04:30 on February 1st in UTC
+        late = self.create_post('late', datetime(2013, 1, 1))
+        late.post_date = timezone.make_aware(datetime(2013, 1, 31, 23, 30), site_timezone)
+        late.save()
+        self.create_post('middle', datetime(2013, 2, 14))
+        self.assertTreeMatchesDatabase(summarize_post_archive)
+        months = summarize_post_archive(Post.query(Post.visible_statuses(False)))['archives'][0]['archives']
+        self.assertEqual([(month['month'], month['count']) for month in months], [(2, 1), (1, 1)])
+
+        late.post_date = timezone.make_aware(datetime(2013, 2, 28, 23, 30), site_timezone)
+        late.save()
+        self.assertTreeMatchesDatabase(summarize_post_archive)
+        late.delete()
+        self.assertTreeMatchesDatabase(summarize_post_archive)
+
+    def test_invalid_archive_periods_are_not_found(self):
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        for year, month in (('2020', '13'), ('0', '1'), ('2020', '0'), ('99999', '1')):
+            self.assertRaises(Http404, archive_articles, request, year, month)
+
+    def test_month_without_a_year_matches_every_year(self):
+        januaries = [self.create_post('january-%d' % year, datetime(year, 1, 15, 12))
+                     for year in (2011, 2013)]
+        self.create_post('june-2012', datetime(2012, 6, 15, 12))
+        public = Post.visible_statuses(False)
+        self.assertEqual(list(Post.query(public, month=1)), januaries[::-1])
+        self.assertEqual(list(Post.query(public, month=3)), [])
+
+    def test_archive_json_is_revalidated_and_compressed(self):
+        # midday UTC, so every post stays in January in the site timezone
+        for day in range(1, 6):
+            self.create_post('a-post-about-archives-%d' % day, datetime(2013, 1, day, 12))
+        url = reverse('metablog_archive_json')
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        body, etag = response.content, response['ETag']
+        self.assertEqual(len(json.loads(body)['archives'][0]['archives'][0]['articles']), 5)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(GzipFile(fileobj=StringIO(response.content)).read(), body)
+        self.assertIn('Accept-Encoding', response['Vary'])
+
+        self.create_post('a-later-post', datetime(2013, 2, 1, 12))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertIn('a-later-post', response.content)
+
+
+################################################################################
+
+class UrlBuilderTest(TestCase):
+    urls = 'cinekine.metablog.urls'
+
+    routes = (
+        ('metablog_article', {'post_slug': 'a-post-2'}),
+        ('metablog_archive_year', {'year': 2013}),
+        ('metablog_archive_year_month', {'year': 2013, 'month': 4}),
+        ('metablog_category', {'category_slug': 'games'}),
+    )
+
+    def test_matches_reverse(self):
+        script_prefix = get_script_prefix()
+        try:
+            for prefix in ('/', '/blog/', '/sites/blog/'):
+                set_script_prefix(prefix)
+                for name, kwargs in self.routes:
+                    self.assertEqual(build_url(name, **kwargs), reverse(name, kwargs=kwargs))
+        finally:
+            set_script_prefix(script_prefix)
+
+    def test_site_urls_follow_the_scheme_setting(self):
+        domain = Site.objects.get_current().domain
+        self.assertEqual(site_url('/rss/'), 'http://%s/rss/' % domain)
+        with override_settings(CK_METABLOG_SITE_SCHEME='https'):
+            self.assertEqual(feed_urls([]), ['https://%s%s' % (domain, reverse('%s-latest' % name))
+                                             for name in FEED_NAMES])
+
+
+################################################################################
+
+class SidebarCacheTest(TestCase):
+    urls = 'cinekine.metablog.urls'
+
+    def setUp(self):
+        cache.clear()
+
+    def test_link_save_invalidates(self):
+        tag = Tag.objects.create(name='Favorites', slug='favorite-blog')
+        self.assertEqual(get_sidebar(False)[2], [])
+
+        misses = sidebar_cache.misses
+        with self.assertNumQueries(0):
+            get_sidebar(False)
+        self.assertEqual(sidebar_cache.misses, misses)
+
+        link = Link.objects.create(tag=tag, rank=1, title='Blog', url='http://example.com/')
+        self.assertEqual(get_sidebar(False)[2], [link])
+        self.assertEqual(sidebar_cache.misses, misses + 1)
+
+
+class TaxonomyTest(TestCase):
+    urls = 'cinekine.metablog.urls'
+
+    def setUp(self):
+        cache.clear()
+        self.games = Tag.objects.create(name='Games', slug='games')
+        self.code = Tag.objects.create(name='Code', slug='code')
+        self.category = Category.objects.create(tag=self.games, long_name='Games')
+
+    def test_slugs_resolve_without_queries(self):
+        self.assertEqual(all_categories(), [self.category])
+        with self.assertNumQueries(0):
+            self.assertEqual(resolve_slug('games'), (self.category, self.games))
+            self.assertEqual(resolve_slug('code'), (None, self.code))
+            self.assertEqual(resolve_slug('missing'), (None, None))
+            self.assertEqual(all_categories(), [self.category])
+
+    def test_lowest_id_wins_repeated_slugs(self):
+        Tag.objects.create(name='Code again', slug='code')
+        self.assertEqual(resolve_slug('code'), (None, self.code))
+
+    def test_changes_invalidate(self):
+        all_categories()
+        self.code.slug = 'programming'
+        self.code.save()
+        self.assertEqual(resolve_slug('programming'), (None, self.code))
+        self.assertEqual(resolve_slug('code'), (None, None))
+
+        category = Category.objects.create(tag=self.code, long_name='Programming')
+        self.assertEqual(all_categories(), [self.category, category])
+        self.assertEqual(resolve_slug('programming'), (category, self.code))
+
+        category.delete()
+        self.assertEqual(all_categories(), [self.category])
+        self.assertEqual(resolve_slug('programming'), (None, self.code))
+
+        self.games.delete()
+        self.assertEqual(all_categories(), [])
+        self.assertEqual(resolve_slug('games'), (None, None))
+
+
+class FeedCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.games = Tag.objects.create(name='Games', slug='games')
+        self.post = create_posts(1)[0]
+        self.post.tags.add(self.games)
+        self.renders = []
+
+    def feed(self, category_slug):
+        def build():
+            self.renders.append(category_slug)
+            return HttpResponse('<rss/>', content_type='application/rss+xml')
+        return get_feed('rss', 'http', category_slug, build)
+
+    def test_post_changes_rebuild_their_categories(self):
+        for slug in (None, 'games', 'code', None):
+            self.feed(slug)
+        self.assertEqual(self.renders, [None, 'games', 'code'])
+
+        with self.assertNumQueries(0):
+            entry = self.feed('games')
+        self.assertEqual(entry['content'], '<rss/>')
+        self.assertEqual(entry['variants'], {})
+
+        self.post.title = 'edited'
+        self.post.save()
+        for slug in (None, 'games', 'code'):
+            self.feed(slug)
+        self.assertEqual(self.renders, [None, 'games', 'code', None, 'games'])
+
+
+@override_settings(CK_METABLOG_FEED_ARCHIVE_PAGE_SIZE=2)
+class FeedArchiveTest(TestCase):
+    urls = 'cinekine.metablog.urls'
+
+    def setUp(self):
+        self.posts = create_posts(5)
+        self.request = RequestFactory().get('/rss/')
+
+    def test_complete_pages_are_archived(self):
+        latest = FeedPage(self.request, None)
+        self.assertEqual(latest.archived_pages, 2)
+        self.assertEqual([rel for rel, href in latest.history_links('rss')], ['prev-archive'])
+        self.assertTrue(latest.history_links('rss')[0][1].endswith('/rss/archive/2/'))
+
+        first = FeedPage(self.request, None, 1)
+        self.assertEqual(list(first.items()), self.posts[:2])
+        self.assertEqual([rel for rel, href in first.history_links('atom')],
+                         ['current', 'next-archive'])
+        self.assertRaises(Http404, FeedPage, self.request, None, 3)
+
+    def test_archive_pages_revalidate_after_a_delete(self):
+        url = reverse('rss-archive', kwargs={'page': 2})
+        response = self.client.get(url)
+        content = ''.join(response.streaming_content)
+        self.assertEqual([title in content for title in ('post 1', 'post 2', 'post 3', 'post 4')],
+                         [False, True, True, False])
+        etag = response['ETag']
+        self.assertEqual(response['Cache-Control'], 'public, max-age=2592000')
+        self.assertFalse(response.has_header('Last-Modified'))
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.posts[0].delete()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_stream_matches_write(self):
+        feed = ExtendedRSSFeed(u'Blog', u'http://example.com/', u'Posts', is_archive=True,
+                               history_links=[(u'current', u'http://example.com/rss/')])
+        for index in range(50):
+            feed.add_item(u'Post %d' % index, u'http://example.com/%d/' % index, u'\xe9' * 500,
+                          content_encoded=u'text')
+        chunks = list(feed.stream('utf-8'))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(''.join(chunks), feed.writeString('utf-8'))
+        self.assertIn('<fh:archive></fh:archive>', feed.writeString('utf-8'))
+
+    def test_json_feed(self):
+        feed = JsonFeed(u'Blog', u'http://example.com/', u'Posts', hub=u'http://hub.example.com/',
+                        history_links=[(u'prev-archive', u'http://example.com/json/archive/2/')])
+        feed.add_item(u'Post', u'http://example.com/post/', u'Summary', content_encoded=u'<p>caf\xe9</p>',
+                      pubdate=datetime(2013, 5, 1, 12, 0), categories=(u'Games',))
+        document = json.loads(feed.writeString('utf-8'))
+        self.assertEqual(document['version'], 'https://jsonfeed.org/version/1.1')
+        self.assertEqual(document['next_url'], 'http://example.com/json/archive/2/')
+        self.assertEqual(document['hubs'], [{'type': 'WebSub', 'url': 'http://hub.example.com/'}])
+        item = document['items'][0]
+        self.assertEqual((item['id'], item['content_html'], item['tags']),
+                         ('http://example.com/post/', u'<p>caf\xe9</p>', ['Games']))
+        self.assertEqual(item['date_published'], '2013-05-01T12:00:00Z')
+
+
+class CompressionTest(TestCase):
+
+    def test_variants_are_served_by_accept_encoding(self):
+        self.assertEqual(accepted_encodings('gzip;q=0, deflate, BR;q=0.5'), set(['deflate', 'br']))
+
+        body = '<rss>%s</rss>' % ('<item/>' * 100)
+        variants = compress_variants(body)
+        factory = RequestFactory()
+
+        response = encoded_response(factory.get('/', HTTP_ACCEPT_ENCODING='gzip'), body, variants,
+                                    'application/rss+xml')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response.content, variants['gzip'])
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+
+        response = encoded_response(factory.get('/', HTTP_ACCEPT_ENCODING='gzip;q=0'), body, variants,
+                                    'application/rss+xml')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response.content, body)
+
+    def test_each_variant_has_its_own_etag(self):
+        body = '<rss>%s</rss>' % ('<item/>' * 100)
+        variants = compress_variants(body)
+        factory = RequestFactory()
+
+        def get(**headers):
+            return variant_response(factory.get('/', **headers), body, variants,
+                                    'application/rss+xml', 'feed-1')
+
+        self.assertEqual(get()['ETag'], '"feed-1"')
+        self.assertEqual(get(HTTP_ACCEPT_ENCODING='gzip')['ETag'], '"feed-1-gzip"')
+
+        response = get(HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH='"feed-1-gzip"')
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(get(HTTP_IF_NONE_MATCH='"feed-1-gzip"').status_code, 200)
+
+
+class PageCacheTest(TestCase):
+    urls = 'cinekine.metablog.urls'
+
+    def setUp(self):
+        cache.clear()
+        self.posts = create_posts(2)
+        self.renders = []
+
+        @cached_page
+        def view(request, post_id):
+            self.renders.append(post_id)
+            depends_on(request, post_generation(post_id))
+            return HttpResponse('post %d' % post_id)
+        self.view = view
+
+    def get(self, post_id, user=None):
+        request = RequestFactory().get('/post-%d/' % post_id)
+        request.user = user or AnonymousUser()
+        return self.view(request, post_id)
+
+    def test_changes_drop_dependent_pages(self):
+        first, second = [post.id for post in self.posts]
+        self.get(first)
+        self.get(second)
+        self.assertEqual(self.get(first).content, 'post %d' % first)
+        self.assertEqual(self.renders, [first, second])
+
+        self.posts[0].text = '<p>edited</p>'
+        self.posts[0].save()
+        self.get(first)
+        self.get(second)
+        self.assertEqual(self.renders, [first, second, first])
+
+        Link.objects.create(tag=Tag.objects.create(name='Favorites', slug='favorite-blog'),
+                            rank=1, title='Blog', url='http://example.com/')
+        self.get(second)
+        self.assertEqual(self.renders, [first, second, first, second])
+
+        self.get(second, self.posts[0].author)
+        self.assertEqual(self.renders, [first, second, first, second, second])
+
+    def test_pages_rendered_before_a_commit_are_dropped_after_it(self):
+        first = self.posts[0].id
+        # saved inside the test's transaction, so not yet committed
+        self.posts[0].text = '<p>edited</p>'
+        self.posts[0].save()
+        self.get(first)
+        self.get(first)
+        self.assertEqual(self.renders, [first])
+
+        request_finished.send(sender=self.__class__)
+        self.get(first)
+        self.assertEqual(self.renders, [first, first])
+
+    def test_pages_with_a_csrf_token_are_not_cached(self):
+        @cached_page
+        def view(request):
+            self.renders.append(get_token(request))
+            return HttpResponse('form')
+
+        for attempt in range(2):
+            request = RequestFactory().get('/form/')
+            request.user = AnonymousUser()
+            response = view(request)
+            self.assertIn('Cookie', response['Vary'])
+        self.assertEqual(len(self.renders), 2)
+
+    @override_settings(TEMPLATE_DIRS=(TEST_TEMPLATES,))
+    def test_views_are_cached_until_their_posts_change(self):
+        first = self.posts[0]
+        first.text = '<p>first</p>'
+        first.save()
+        for url in (article_url(first.slug), reverse('metablog_home')):
+            self.assertIn('<p>first</p>', self.client.get(url).content)
+            with self.assertNumQueries(0):
+                response = self.client.get(url)
+            self.assertIn('<p>first</p>', response.content)
+            self.assertIn('Cookie', response['Vary'])
+
+        first.text = '<p>edited</p>'
+        first.save()
+        for url in (article_url(first.slug), reverse('metablog_home')):
+            self.assertIn('<p>edited</p>', self.client.get(url).content)
+
+
+@override_settings(CK_METABLOG_PER_PAGE_COUNT=2, CK_METABLOG_FEED_ARCHIVE_PAGE_SIZE=2)
+class StaticExportTest(TestCase):
+    urls = 'cinekine.metablog.urls'
+
+    def setUp(self):
+        cache.clear()
+        self.posts = create_posts(3)
+        self.favorites = Tag.objects.create(name='Favorites', slug='favorite-blog')
+
+    def test_only_affected_pages_are_stale(self):
+        first, second, third = [post.id for post in self.posts]
+        pages = dict((page.key, page) for page in site_pages())
+        self.assertEqual(pages['/'].post_ids, [third, second])
+        self.assertEqual(pages['/?start=2'].post_ids, [first])
+        self.assertEqual(pages['/rss/archive/1/'].post_ids, [first, second])
+        self.assertTrue(pages['/atom/'].feed)
+
+        fingerprints = site_fingerprints()
+        manifest = dict(fingerprints, pages=dict(
+            (key, {'posts': page.post_ids}) for key, page in pages.items()))
+        self.assertEqual(stale_pages(pages.values(), manifest, set(), fingerprints), [])
+
+        stale = stale_pages(pages.values(), manifest, set([first]), fingerprints)
+        self.assertIn(pages['/?start=2'], stale)
+        self.assertIn(pages['/rss/archive/1/'], stale)
+        self.assertNotIn(pages['/'], stale)
+
+        Link.objects.create(tag=self.favorites, rank=1, title='Blog', url='http://example.com/')
+        stale = stale_pages(pages.values(), manifest, set(), site_fingerprints())
+        self.assertIn(pages['/'], stale)
+        self.assertNotIn(pages['/rss/'], stale)
+
+
+@override_settings(CK_METABLOG_SITEMAP_SHARD_SIZE=2)
+class SitemapTest(TestCase):
+    urls = 'cinekine.metablog.urls'
+
+    def setUp(self):
+        cache.clear()
+        self.posts = create_posts(3)
+
+    def get(self, shard):
+        return self.client.get(reverse('metablog_sitemap_posts', kwargs={'shard': shard}))
+
+    def test_only_changed_shards_are_regenerated(self):
+        shards = [post.id // 2 for post in self.posts]
+        self.assertEqual(post_shards(), sorted(set(shards)))
+
+        index = ''.join(self.client.get(reverse('metablog_sitemap')).streaming_content)
+        self.assertIn('sitemap-posts-%d.xml' % shards[0], index)
+
+        response = self.get(shards[0])
+        self.assertTrue(response.streaming)
+        content = ''.join(response.streaming_content)
+        self.assertIn('/post-0/</loc>', content)
+        self.assertIn('<priority>0.5</priority>', content)
+        with self.assertNumQueries(0):
+            self.assertFalse(self.get(shards[0]).streaming)
+        self.assertEqual(self.get(max(shards) + 1).status_code, 404)
+        # shards[0] is cached already; render and cache the others
+        for shard in set(shards) - set([shards[0]]):
+            ''.join(self.get(shard).streaming_content)
+
+        self.posts[2].search_priority = Post.HIGHLIGHTED
+        self.posts[2].save()
+        for post, shard in zip(self.posts, shards):
+            self.assertEqual(self.get(shard).streaming, shard == shards[2])
+
+
+################################################################################
+
+class CursorPaginationTest(TestCase):
+
+    def setUp(self):
+        author = User.objects.create(username='author')
+        for day in (1, 2, 2, 3, 4):
+            post = Post.objects.create(author=author, title='post', slug='post',
+                                       status=Post.PUBLISHED, text='')
+            post.post_date = timezone.make_aware(datetime(2013, 5, day), timezone.utc)
+            post.save()
+        self.all_posts = Post.query(Post.visible_statuses(False))
+        self.expected = list(self.all_posts.values_list('id', flat=True))
+
+    def test_walk_older_and_newer(self):
+        pages = []
+        posts, first_id, next_cursor, prev_cursor = cursor_page(self.all_posts, None, 2)
+        self.assertEqual(next_cursor, None)
+        while True:
+            pages.append([post.id for post in posts])
+            if prev_cursor is None:
+                break
+            posts, first_id, next_cursor, prev_cursor = cursor_page(self.all_posts, prev_cursor, 2)
+        self.assertEqual(sum(pages, []), self.expected)
+
+        newer = []
+        while next_cursor is not None:
+            posts, first_id, next_cursor, prev_cursor = cursor_page(self.all_posts, next_cursor, 2)
+            newer.insert(0, [post.id for post in posts])
+        self.assertEqual(newer, pages[:-1])
+
+    def test_start_offset_still_works(self):
+        posts, first_id, next_cursor, prev_cursor = cursor_page(self.all_posts, None, 2, 2)
+        self.assertEqual([post.id for post in posts], self.expected[2:4])
+        self.assertNotEqual(next_cursor, None)
+        self.assertNotEqual(prev_cursor, None)
+
+    def test_start_past_the_end_shows_the_last_post(self):
+        posts, first_id, next_cursor, prev_cursor = cursor_page(self.all_posts, None, 2, 50)
+        self.assertEqual([post.id for post in posts], self.expected[-1:])
+        self.assertNotEqual(next_cursor, None)
+        self.assertEqual(prev_cursor, None)
+
+    def test_malformed_cursor_starts_at_first_page(self):
+        for cursor in ('not-a-cursor', urlsafe_b64encode('o.%d.1' % 10 ** 30),
+                       urlsafe_b64encode('o.-%d.1' % 10 ** 17)):
+            posts, first_id, next_cursor, prev_cursor = cursor_page(self.all_posts, cursor, 2)
+            self.assertEqual(first_id, self.expected[0])
+
+
+################################################################################
+
+class ListingQueryTest(TestCase):
+
+    def setUp(self):
+        self.author = User.objects.create(username='author')
+        self.tags = [Tag.objects.create(name='tag%d' % i, slug='tag%d' % i) for i in range(3)]
+
+    def add_posts(self, count):
+        for i in range(count):
+            post = Post.objects.create(author=self.author, title='post', slug='post',
+                                       status=Post.PUBLISHED, text='')
+            post.tags.add(*self.tags)
+
+    def render_listing(self):
+        for post in Post.query(Post.visible_statuses(False), listing=True)[:20]:
+            post.author.username
+            [tag.slug for tag in post.tags.all()]
+
+    def test_query_count_independent_of_post_count(self):
+        self.add_posts(2)
+        with self.assertNumQueries(2):
+            self.render_listing()
+
+        self.add_posts(8)
+        with self.assertNumQueries(2):
+            self.render_listing()
+
+
+################################################################################
+
+class PostTagIndexTest(TestCase):
+
+    def setUp(self):
+        self.games = Tag.objects.create(name='Games', slug='games')
+        self.code = Tag.objects.create(name='Code', slug='code')
+        self.post = create_posts(1)[0]
+        self.post.tags.add(self.games, self.code)
+
+    def test_listing_is_distinct_and_follows_status(self):
+        public = Post.visible_statuses(False)
+        tags = [self.games, self.code]
+        self.assertEqual(list(Post.query(public, tags)), [self.post])
+
+        self.post.status = Post.DRAFT
+        self.post.save()
+        self.assertEqual(list(Post.query(public, tags)), [])
+
+        self.post.tags.remove(self.games)
+        self.assertEqual(list(Post.query(Post.visible_statuses(True), [self.games])), [])
+        self.assertEqual(list(Post.query(Post.visible_statuses(True), [self.code])), [self.post])
+
+    def test_listing_is_ordered_and_paged_on_the_index(self):
+        older = Post.objects.create(author=self.post.author, title='older', slug='older',
+                                    status=Post.PUBLISHED, text='')
+        older.tags.add(self.games)
+        # post_date is set on creation, so back-date it with a second save
+        older.post_date = self.post.post_date - timedelta(days=1)
+        older.save()
+        listing = Post.query(Post.visible_statuses(False), [self.games, self.code])
+        self.assertEqual(list(listing), [self.post, older])
+        self.assertEqual(list(listing[1:2]), [older])
+        self.assertEqual(listing.count(), 2)
+
+
+class SearchTest(TestCase):
+
+    def setUp(self):
+        author = User.objects.create(username='author')
+        self.engine = Post.objects.create(author=author, title='Writing an engine', slug='engine',
+                                          status=Post.PUBLISHED, text='<p>Sprites and shaders.</p>')
+        self.shaders = Post.objects.create(author=author, title='Shaders', slug='shaders',
+                                           status=Post.PUBLISHED, text='<p>More shaders.</p>',
+                                           search_priority=Post.HIGHLIGHTED)
+        self.draft = Post.objects.create(author=author, title='Draft shaders', slug='draft',
+                                         status=Post.DRAFT, text='')
+
+    def test_tokenize(self):
+        self.assertEqual(tokenize(u'The Engine of a game'), [u'engine', u'game'])
+
+    def test_results_are_ranked_and_follow_status(self):
+        public = Post.query(Post.visible_statuses(False))
+        self.assertEqual(list(search_posts('shaders', public)), [self.shaders, self.engine])
+        self.assertEqual(list(search_posts('engine shaders', public)), [self.engine, self.shaders])
+        self.assertEqual(list(search_posts('the', public)), [])
+
+        self.engine.tags.add(Tag.objects.create(name='Rendering', slug='rendering'))
+        self.assertEqual(list(search_posts('rendering', public)), [self.engine])
+
+        admin = Post.query(Post.visible_statuses(True))
+        self.assertIn(self.draft, list(search_posts('shaders', admin)))
+
+    def test_removed_tags_leave_the_index(self):
+        public = Post.query(Post.visible_statuses(False))
+        rendering = Tag.objects.create(name='Rendering', slug='rendering')
+        self.engine.tags.add(rendering)
+        rendering.post_set.clear()
+        self.assertEqual(list(search_posts('rendering', public)), [])
+
+        self.engine.tags.add(rendering)
+        rendering.delete()
+        self.assertEqual(list(search_posts('rendering', public)), [])
+
+    def test_pages_of_results(self):
+        results = search_posts('shaders', Post.query(Post.visible_statuses(False), listing=True))
+        with self.assertNumQueries(1):
+            self.assertEqual(results.count(), 2)
+        # the ranked ids, then the page's posts with their tags
+        with self.assertNumQueries(3):
+            self.assertEqual(results[1:2], [self.engine])
+
+    def test_rebuild_reads_posts_once(self):
+        # clear the postings, read tag names and posts, write the postings
+        with self.assertNumQueries(4):
+            self.assertEqual(rebuild_index(processes=1), 3)
+
+    @override_settings(CK_METABLOG_SEARCH_BACKEND='sqlite')
+    def test_sqlite_backend(self):
+        if connection.vendor != 'sqlite':
+            return
+        self.assertEqual(rebuild_index(), 3)
+        public = Post.query(Post.visible_statuses(False))
+        self.assertEqual(list(search_posts('shaders', public)), [self.shaders, self.engine])
+
+        self.engine.title = 'Writing a renderer'
+        self.engine.save()
+        self.assertEqual(list(search_posts('renderer', public)), [self.engine])
+
+
+class RelatedPostsTest(TestCase):
+
+    def setUp(self):
+        author = User.objects.create(username='author')
+        self.games = Tag.objects.create(name='Games', slug='games')
+
+        def post(slug, text, status=Post.PUBLISHED):
+            return Post.objects.create(author=author, title=slug, slug=slug, status=status, text=text)
+        self.sprites = post('sprites', '<p>Drawing sprites with shaders.</p>')
+        self.shaders = post('shaders', '<p>Writing shaders for sprites.</p>')
+        self.garden = post('garden', '<p>Tomatoes in the garden.</p>')
+        self.public = Post.visible_statuses(False)
+
+    def related(self, post):
+        # related posts come with 'text' deferred, so compare them by id
+        return [related.id for related in related_posts(post, self.public)]
+
+    def test_rebuild_and_refresh(self):
+        rebuild_related_posts()
+        self.assertEqual(self.related(self.sprites), [self.shaders.id])
+
+        self.garden.tags.add(self.games)
+        self.sprites.tags.add(self.games)
+        self.assertEqual(refresh_related_posts(), 3)
+        self.assertEqual(self.related(self.sprites), [self.garden.id, self.shaders.id])
+        self.assertEqual(self.related(self.garden), [self.sprites.id])
+
+        self.shaders.status = Post.DRAFT
+        self.shaders.save()
+        refresh_related_posts()
+        self.assertEqual(self.related(self.sprites), [self.garden.id])
+        self.assertEqual(refresh_related_posts(), 0)
+
+
+class PostChainTest(TestCase):
+
+    def setUp(self):
+        self.posts = create_posts(4)
+
+    def chain(self):
+        post = Post.objects.get(prev_post=None, status=Post.PUBLISHED)
+        chain = [post]
+        while post.next_post_id is not None:
+            post = Post.objects.get(pk=post.next_post_id)
+            self.assertEqual(post.prev_post_id, chain[-1].id)
+            chain.append(post)
+        return chain
+
+    def test_posts_are_relinked(self):
+        first, second, third, fourth = self.posts
+        self.assertEqual(self.chain(), self.posts)
+
+        second.status = Post.DRAFT
+        second.save()
+        self.assertEqual(self.chain(), [first, third, fourth])
+        self.assertEqual(Post.objects.get(pk=second.pk).next_post, None)
+
+        # publishing again moves it to the end
+        second.status = Post.PUBLISHED
+        second.save()
+        self.assertEqual(self.chain(), [first, third, fourth, second])
+
+        third.delete()
+        self.assertEqual(self.chain(), [first, fourth, second])
+
+        Post.objects.update(prev_post=None, next_post=None)
+        self.assertEqual(rebuild_post_chain(), 3)
+        self.assertEqual(self.chain(), [first, fourth, second])
+
+        Post.objects.filter(pk=fourth.pk).delete()
+        self.assertEqual(self.chain(), [first, second])
+
+
+class PostChainTransactionTest(TransactionTestCase):
+
+    def test_relinking_leaves_the_callers_transaction_open(self):
+        author = User.objects.create(username='author')
+        post = Post.objects.create(author=author, title='post', slug='post',
+                                   status=Post.PUBLISHED, text='')
+        with transaction.commit_manually():
+            try:
+                Post.objects.create(author=author, title='later', slug='later',
+                                    status=Post.PUBLISHED, text='')
+                post.status = Post.DRAFT
+                post.save()
+            finally:
+                transaction.rollback()
+
+        self.assertEqual(list(Post.objects.values_list('id', flat=True)), [post.id])
+        post = Post.objects.get(pk=post.pk)
+        self.assertEqual((post.status, post.next_post_id), (Post.PUBLISHED, None))
+
+
+################################################################################
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.handle_request('')
+
+    def do_POST(self):
+        self.handle_request(self.rfile.read(int(self.headers.getheader('content-length', 0))))
+
+    def handle_request(self, body):
+        self.server.requests.append((self.command, self.path, body))
+        self.send_response(self.server.status)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(HTTPServer):
+    """
+    Local HTTP endpoint standing in for search engines and hubs.  Records
+    each request as (method, path, body) and answers with 'status'.
+    """
+    def __init__(self, status=200):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.requests = []
+        self.status = status
+        self.url = 'http://127.0.0.1:%d/' % self.server_port
+        self.thread = Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class PingQueueTest(TestCase):
+    urls = 'cinekine.metablog.urls'
+    sitemap = 'http://example.com/sitemap.xml'
+
+    def setUp(self):
+        self.server = StandInServer()
+        self.settings_override = override_settings(
+            CK_METABLOG_PING_GOOGLE=True,
+            CK_METABLOG_PING_URL=self.server.url,
+            CK_METABLOG_PING_SITEMAP_URL=self.sitemap,
+            CK_METABLOG_PING_WINDOW=30)
+        self.settings_override.enable()
+        self.author = User.objects.create(username='author')
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.server.stop()
+
+    def publish(self):
+        post = Post.objects.create(author=self.author, title='post', slug='post',
+                                   status=Post.DRAFT, text='')
+        post.status = Post.PUBLISHED
+        post.save()
+        return post
+
+    def test_pings_in_window_are_batched(self):
+        first = self.publish()
+        second = self.publish()
+        self.assertEqual(Ping.objects.filter(status=Ping.PENDING).count(), 2)
+
+        self.assertEqual(process_pending_pings(), 0)
+        self.assertEqual(self.server.requests, [])
+
+        self.assertEqual(process_pending_pings(timezone.now() + timedelta(seconds=31)), 2)
+        self.assertEqual(len(self.server.requests), 1)
+        method, path, body = self.server.requests[0]
+        self.assertEqual(parse_qs(urlparse(path).query), {'sitemap': [self.sitemap]})
+
+        self.assertEqual(Post.objects.get(pk=first.pk).pings, 1)
+        self.assertEqual(Post.objects.get(pk=second.pk).pings, 1)
+
+        # a stale instance doesn't overwrite the counter.
+        first.title = 'retitled'
+        first.save()
+        self.assertEqual(Post.objects.get(pk=first.pk).pings, 1)
+
+    def test_stale_instance_of_a_deleted_post_is_saved_again(self):
+        post = self.publish()
+        Post.objects.filter(pk=post.pk).delete()
+        post.title = 'restored'
+        post.save()
+        self.assertEqual(Post.objects.get(pk=post.pk).title, 'restored')
+
+    def test_publishing_without_a_sitemap_is_logged(self):
+        with override_settings(CK_METABLOG_PING_SITEMAP_URL=None, ROOT_URLCONF='cinekine.metablog.test_urls'):
+            post = self.publish()
+        self.assertEqual(Post.objects.get(pk=post.pk).status, Post.PUBLISHED)
+        self.assertEqual(Ping.objects.count(), 0)
+
+    def test_websub_publish_names_changed_feeds(self):
+        games = Tag.objects.create(name='Games', slug='games')
+        Category.objects.create(tag=games, long_name='Games')
+        post = self.publish()
+        post.tags.add(games)
+
+        with override_settings(CK_METABLOG_PING_GOOGLE=False, CK_METABLOG_WEBSUB_HUB=self.server.url,
+                               CK_METABLOG_WEBSUB_WINDOW=5):
+            post.title = 'edited'
+            post.save()
+            # already pending; announced by the same publish request
+            post.save()
+
+        self.assertEqual(Ping.objects.filter(kind=Ping.WEBSUB).count(), 6)
+        process_pending_pings(timezone.now() + timedelta(seconds=31))
+
+        websub = [request for request in self.server.requests if request[0] == 'POST']
+        self.assertEqual(len(websub), 1)
+        params = parse_qs(websub[0][2])
+        self.assertEqual(params['hub.mode'], ['publish'])
+        self.assertEqual(sorted(urlparse(url).path for url in params['hub.url']),
+                         ['/atom/', '/category/games/atom/', '/category/games/json/',
+                          '/category/games/rss/', '/json/', '/rss/'])
+        self.assertEqual(Post.objects.get(pk=post.pk).pings, 1)
+
+    def test_failed_ping_backs_off(self):
+        self.server.status = 500
+        self.publish()
+        later = timezone.now() + timedelta(seconds=31)
+        self.assertEqual(process_pending_pings(later), 0)
+
+        ping = Ping.objects.get()
+        self.assertEqual((ping.status, ping.attempts), (Ping.PENDING, 1))
+        self.assertTrue(ping.due_date > later)
+
+        self.server.status = 200
+        self.assertEqual(process_pending_pings(ping.due_date), 1)
+        self.assertEqual(Ping.objects.get().status, Ping.SENT)
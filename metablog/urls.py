@@ -1,11 +1,27 @@
 from django.conf.urls.defaults import patterns, url
-from cinekine.metablog.feeds import PostFeed, AtomPostFeed
+from cinekine.metablog.feeds import PostFeed, AtomPostFeed, JsonPostFeed
 
 urlpatterns = patterns(
     '',
     # View by permalink
     url(r'^article/(?P<post_slug>[a-zA-Z0-9\^-]+)/$', 'cinekine.metablog.views.article',
         name='metablog_article'),
+    # Archive tree (JSON)
+    url(r'^archive/json/$', 'cinekine.metablog.views.archive_json',
+        name='metablog_archive_json'),
+    # Articles of an archive month (JSON)
+    url(r'^archive/(?P<year>[0-9]+)/(?P<month>[0-9]+)/articles/$', 'cinekine.metablog.views.archive_articles',
+        name='metablog_archive_year_month_articles'),
+    # Sitemap index and its sitemaps
+    url(r'^sitemap\.xml$', 'cinekine.metablog.sitemap.sitemap_index',
+        name='metablog_sitemap'),
+    url(r'^sitemap-pages\.xml$', 'cinekine.metablog.sitemap.sitemap_pages',
+        name='metablog_sitemap_pages'),
+    url(r'^sitemap-posts-(?P<shard>[0-9]+)\.xml$', 'cinekine.metablog.sitemap.sitemap_posts',
+        name='metablog_sitemap_posts'),
+    # Full-text search
+    url(r'^search/$', 'cinekine.metablog.views.search',
+        name='metablog_search'),
     # View archived posts by date
     url(r'^archive/(?P<year>[0-9]+)/(?P<month>[0-9]+)/$', 'cinekine.metablog.views.archive',
         name='metablog_archive_year_month'),
@@ -16,12 +32,23 @@ urlpatterns = patterns(
     url(r'^category/(?P<category_slug>[a-zA-Z0-9\^-]+)/rss/$', PostFeed(),
         name="rss-category-latest"),
     url(r'^category/(?P<category_slug>[a-zA-Z0-9\^-]+)/atom/$', AtomPostFeed(), name='atom-category-latest'),
+    url(r'^category/(?P<category_slug>[a-zA-Z0-9\^-]+)/json/$', JsonPostFeed(), name='json-category-latest'),
+    url(r'^category/(?P<category_slug>[a-zA-Z0-9\^-]+)/rss/archive/(?P<page>[0-9]+)/$', PostFeed(),
+        name='rss-category-archive'),
+    url(r'^category/(?P<category_slug>[a-zA-Z0-9\^-]+)/atom/archive/(?P<page>[0-9]+)/$', AtomPostFeed(),
+        name='atom-category-archive'),
+    url(r'^category/(?P<category_slug>[a-zA-Z0-9\^-]+)/json/archive/(?P<page>[0-9]+)/$', JsonPostFeed(),
+        name='json-category-archive'),
     url(r'^category/(?P<category_slug>[a-zA-Z0-9\^-]+)/$', 'cinekine.metablog.views.home',
         name='metablog_category'),
 
     # Default Home page
     url(r'^rss/$', PostFeed(), {'category_slug': None}, name="rss-latest"),
     url(r'^atom/$', AtomPostFeed(), {'category_slug': None}, name='atom-latest'),
+    url(r'^json/$', JsonPostFeed(), {'category_slug': None}, name='json-latest'),
+    url(r'^rss/archive/(?P<page>[0-9]+)/$', PostFeed(), {'category_slug': None}, name='rss-archive'),
+    url(r'^atom/archive/(?P<page>[0-9]+)/$', AtomPostFeed(), {'category_slug': None}, name='atom-archive'),
+    url(r'^json/archive/(?P<page>[0-9]+)/$', JsonPostFeed(), {'category_slug': None}, name='json-archive'),
     url(r'^$', 'cinekine.metablog.views.home', {'category_slug': None},
         name='metablog_home'),
 )
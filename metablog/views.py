@@ -5,14 +5,23 @@
 
 from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext
-from django.http import Http404
+from django.http import Http404, HttpResponse
 from django.conf import settings
-from django.core.urlresolvers import reverse
-
-from models import Post, Category, Link, Tag
+from django.core.cache import cache
+from django.utils.cache import patch_vary_headers
+
+from models import Post
+from archive_tree import get_archive_tree, month_articles, archive_mode, ARCHIVE_SUMMARY
+from sidebar import get_sidebar
+from taxonomy import resolve_slug
+from search import search_posts
+from related import related_posts, RELATED_GENERATION
+from pagination import cursor_page, pagination_mode, PAGINATE_CURSOR
+from compression import compress_variants, variant_response
+from page_cache import cached_page, depends_on, post_generation, tag_generation
 
 from datetime import datetime
-from datetime import date
+from datetime import date, MINYEAR, MAXYEAR
 from time import mktime
 
 import json
@@ -27,144 +36,31 @@ class JsonDatetimeEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
-def create_post_archive(posts):
+def common(is_admin, archive_month=None):
     """
-    Order posts by post date from latest to earliest, returning
-    the posts in hierachicial JSON form:
-    {
-        archives: [
-            {
-                key: "<year>"
-                uri: "<year>/",
-                count: <post count>,
-                archives: [
-                    {
-                        key: "<month>",
-                        uri: "<year>/<month>"
-                        count: <post count>,
-                        >
-                        articles: [
-                            {
-                                title: "<title>",
-                                uri: "<year>/",
-                                date: <datetime>
-                                id: <post id, guaranteed to the unique per article>
-                            },
-                            ...
-                        ],
-                    },
-                    ...
-                ],
-            },
-            ...
-        ]
-    }
+    Sidebar data shared by all views.  archive_month is an optional
+    (year, month) whose articles are listed in a summary archive.
     """
-    posts = posts.all().values('id', 'title', 'slug', 'post_date', 'status')
-
-    archive_stack = []
-    archive_stack.append([])        # archive list (top-level contains years)
-
-    year = -1
-    year_count = 0
-    month = -1
-    month_count = 0
-
-    for post in posts:
-        post_date = post['post_date']
-
-        if year != post_date.year:
-            if year != -1:
-                # fixup stack - top = articles,
-                # fixup stack - top-1 = months
-                articles = archive_stack.pop()
-                months = archive_stack.pop()
-                months[-1]['articles'] = articles
-                months[-1]['count'] = month_count
-                year_count += month_count
-                month_count = 0
-                archive_stack[-1][-1]['archives'] = months
-                archive_stack[-1][-1]['count'] = year_count
-                year_count = 0
-
-            year = post_date.year
-            archive = {
-                'key': str(year),
-                'uri': reverse('metablog_archive_year', kwargs={'year': year}),
-                'count': 0,
-            }
-            archive_stack[-1].append(archive)  # append year to years array (stack top)
-
-            month = -1
-            archive_stack.append([])    # append new months array to stack top.
-
-        if month != post_date.month:
-            if month != -1:
-                # fixup stack - top = articles
-                articles = archive_stack.pop()
-                archive_stack[-1][-1]['articles'] = articles
-                archive_stack[-1][-1]['count'] = month_count
-                year_count += month_count
-                month_count = 0
-
-            month = post_date.month
-            archive = {
-                'key': post_date.strftime("%B"),
-                'uri': reverse('metablog_archive_year_month', kwargs={'year': year, 'month': month}),
-                'count': 0,
-            }
-            archive_stack[-1].append(archive)  # append month to months array (stack top)
-
-            archive_stack.append([])    # append new articles array to stack top.
-
-        # add article link
-        article = {
-            'title': post['title'],
-            'uri': reverse('metablog_article', kwargs={'post_slug': post['slug']}),
-            'date': post_date,
-            'id': post['id']
-        }
-        archive_stack[-1].append(article)
-        month_count += 1
-
-    # final fixup.
-    if len(archive_stack) == 3:
-        # fixup stack - top = articles,
-        # fixup stack - top-1 = months
-        articles = archive_stack.pop()
-        months = archive_stack.pop()
-        months[-1]['articles'] = articles
-        months[-1]['count'] = month_count
-        year_count += month_count
-        archive_stack[-1][-1]['archives'] = months
-        archive_stack[-1][-1]['count'] = year_count
-    else:
-        return None
-
-    return {
-        'archives': archive_stack.pop()
-    }
-
+    categories, archives, blogroll = get_sidebar(is_admin)
 
-def common(is_admin):
-    categories = Category.objects.all()
+    statuses_to_display = Post.visible_statuses(is_admin)
 
-    statuses_to_display = [Post.PUBLISHED, Post.EXCLUSIVE, Post.CLOSED]
-    if is_admin:
-        statuses_to_display.append(Post.DRAFT)
-        statuses_to_display.append(Post.HIDDEN)
+    if archive_month and archive_mode() == ARCHIVE_SUMMARY:
+        archives = get_archive_tree(is_admin).expanded(*archive_month)
 
-    archives = create_post_archive(Post.query(statuses=statuses_to_display))
-    blogroll = None
-    try:
-        favorites_tag = Tag.objects.get(slug='favorite-blog')
-    except:
-        favorites_tag = None
+    return categories, statuses_to_display, archives, blogroll
 
-    if favorites_tag:
-        blogroll = Link.objects.filter(tag__exact=favorites_tag).order_by('rank')
 
-    return categories, statuses_to_display, archives, blogroll
+def archive_period(year, month, whole_year=True):
+    """
+    (year, month) of an archive URL as integers.  Raises Http404 for a month
+    outside 1-12 (0 selects the whole year if whole_year is set), or a year
+    whose date range can't be represented.
+    """
+    year, month = int(year), int(month)
+    if not MINYEAR < year < MAXYEAR or not (0 if whole_year else 1) <= month <= 12:
+        raise Http404
+    return year, month
 
 
 def cull_posts(all_posts, article_post_index, post_page_count):
@@ -200,8 +96,44 @@ def cull_posts(all_posts, article_post_index, post_page_count):
     return posts, first_post_id, next_post_index, prev_post_index
 
 
+def paginate_posts(request, all_posts, article_post_index):
+    """
+    Pages through all_posts with cull_posts, or by keyset cursor when
+    CK_METABLOG_PAGINATION is 'cursor'.  Returns the page's template context.
+    """
+    next_cursor = None
+    prev_cursor = None
+    if pagination_mode() == PAGINATE_CURSOR:
+        posts, first_post_id, next_cursor, prev_cursor = cursor_page(
+                    all_posts,
+                    request.GET.get('cursor'),
+                    settings.CK_METABLOG_PER_PAGE_COUNT,
+                    article_post_index)
+        next_post_index = -1
+        prev_post_index = -1
+    else:
+        posts, first_post_id, next_post_index, prev_post_index = cull_posts(
+                    all_posts,
+                    article_post_index,
+                    settings.CK_METABLOG_PER_PAGE_COUNT)
+
+    return {
+        'blog_posts': posts,
+        'first_post_id': first_post_id,
+        'next_post_index': next_post_index,
+        'prev_post_index': prev_post_index,
+        'next_cursor': next_cursor,
+        'prev_cursor': prev_cursor,
+    }
+
+
+def depends_on_posts(request, posts):
+    depends_on(request, *[post_generation(post.id) for post in posts or () if post is not None])
+
+
 ###############################################################################
 
+@cached_page
 def home(request, category_slug):
     """
         Homepage
@@ -220,41 +152,30 @@ def home(request, category_slug):
     selected_category = None
 
     if category_slug:
-        for category in categories:
-            if category.tag.slug == category_slug:
-                search_tags.append(category.tag)
-                selected_category = category
-
-        # check if this is a tag
-        if selected_category is None:
-            try:
-                search_tag = Tag.objects.get(slug=category_slug)
-                search_tags.append(search_tag)
-            except:
-                print "No tag found for given slug '" + category_slug
+        # category or plain tag
+        selected_category, search_tag = resolve_slug(category_slug)
+        if search_tag is not None:
+            search_tags.append(search_tag)
+        else:
+            print "No tag found for given slug '" + category_slug
 
     all_posts = Post.query(statuses_to_display,
-                           search_tags
+                           search_tags,
+                           listing=True
                            )
 
-    # cap post start and end ranges based on available posts
-    posts, first_post_id, next_post_index, prev_post_index = cull_posts(
-                    all_posts,
-                    article_post_index,
-                    settings.CK_METABLOG_PER_PAGE_COUNT)
-
     context = {
         'page_title': settings.CK_SITE_TITLE,
         'categories': categories,
         'selected_category': selected_category,
-        'blog_posts': posts,
         'archives': archives,
         'blogroll': blogroll,
-        'first_post_id': first_post_id,
-        'next_post_index': next_post_index,
-        'prev_post_index': prev_post_index,
         'allow_rss_feed': True,
     }
+    # cap post start and end ranges based on available posts
+    context.update(paginate_posts(request, all_posts, article_post_index))
+    depends_on_posts(request, context['blog_posts'])
+    depends_on(request, *[tag_generation(tag.id) for tag in search_tags])
 
     # render
     return render_to_response("home.html",
@@ -262,6 +183,7 @@ def home(request, category_slug):
                               context_instance=RequestContext(request))
 
 
+@cached_page
 def archive(request, year, month):
     """
         Homepage
@@ -269,8 +191,12 @@ def archive(request, year, month):
         @param request Incoming HTTP request
         @param category_slug (optional) Incoming category_slug (used in the request URL.)
     """
+    year, month = archive_period(year, month)
+
     # find category if passed into the request
-    categories, statuses_to_display, archives, blogroll = common(request.user.is_authenticated())
+    categories, statuses_to_display, archives, blogroll = common(
+        request.user.is_authenticated(),
+        (year, month) if month else None)
 
     article_post_index = 0
     if 'start' in request.GET:
@@ -281,19 +207,15 @@ def archive(request, year, month):
 
     all_posts = Post.query(statuses_to_display,
                            search_tags,
-                           year, month
+                           year, month,
+                           listing=True
                            )
 
-    # cap post start and end ranges based on available posts
-    posts, first_post_id, next_post_index, prev_post_index = cull_posts(all_posts,
-                    article_post_index,
-                    settings.CK_METABLOG_PER_PAGE_COUNT)
-
     archive_month = False
     if not month:
-        archive_date = date(int(year), 1, 1)
+        archive_date = date(year, 1, 1)
     else:
-        archive_date = date(int(year), int(month), 1)
+        archive_date = date(year, month, 1)
         archive_month = True
 
     context = {
@@ -302,13 +224,56 @@ def archive(request, year, month):
         'selected_category': selected_category,
         'archive_date': archive_date,
         'archive_month': archive_month,
-        'blog_posts': posts,
         'archives': archives,
         'blogroll': blogroll,
+    }
+    # cap post start and end ranges based on available posts
+    context.update(paginate_posts(request, all_posts, article_post_index))
+    depends_on_posts(request, context['blog_posts'])
+
+    # render
+    return render_to_response("home.html",
+                              context,
+                              context_instance=RequestContext(request))
+
+
+def search(request):
+    """
+        Posts matching the 'q' query parameter, most relevant first.
+
+        @param request Incoming HTTP request
+    """
+    categories, statuses_to_display, archives, blogroll = common(request.user.is_authenticated())
+
+    article_post_index = 0
+    if 'start' in request.GET:
+        article_post_index = int(request.GET['start'])
+
+    search_query = request.GET.get('q', '').strip()
+    all_posts = search_posts(search_query,
+                             Post.query(statuses_to_display,
+                                        listing=True
+                                        ))
+
+    context = {
+        'page_title': settings.CK_SITE_TITLE,
+        'categories': categories,
+        'selected_category': None,
+        'search_query': search_query,
+        'archives': archives,
+        'blogroll': blogroll,
+    }
+    # results are ranked rather than dated, so page by offset only
+    posts, first_post_id, next_post_index, prev_post_index = cull_posts(
+                all_posts,
+                article_post_index,
+                settings.CK_METABLOG_PER_PAGE_COUNT)
+    context.update({
+        'blog_posts': posts,
         'first_post_id': first_post_id,
         'next_post_index': next_post_index,
         'prev_post_index': prev_post_index,
-    }
+    })
 
     # render
     return render_to_response("home.html",
@@ -316,11 +281,60 @@ def archive(request, year, month):
                               context_instance=RequestContext(request))
 
 
+def archive_articles(request, year, month):
+    """
+        Articles of a single archive month as JSON, used to expand a month of
+        a summary archive on demand.
+
+        @param request Incoming HTTP request
+        @param year Archive year
+        @param month Archive month
+    """
+    year, month = archive_period(year, month, whole_year=False)
+    statuses_to_display = Post.visible_statuses(request.user.is_authenticated())
+    articles = month_articles(statuses_to_display, year, month)
+
+    return HttpResponse(json.dumps({'articles': articles}, cls=JsonDatetimeEncoder),
+                        content_type='application/json')
+
+
+ARCHIVE_JSON_KEY = 'metablog:archive-json:%s:%s:%d'
+
+
+def archive_json(request):
+    """
+        The sidebar archive tree as JSON (see create_post_archive).
+
+        The tree is encoded once per archive version and the bytes, plus
+        their compressed variants, are cached under that version for later
+        requests.  Clients holding the current version get a 304.
+
+        @param request Incoming HTTP request
+    """
+    is_admin = request.user.is_authenticated()
+    tree = get_archive_tree(is_admin)
+
+    visitors = 'admin' if is_admin else 'public'
+    key = ARCHIVE_JSON_KEY % (archive_mode(), visitors, tree.version)
+    encoded = cache.get(key)
+    if encoded is None:
+        body = json.dumps(tree.as_dict() or {'archives': []}, cls=JsonDatetimeEncoder)
+        encoded = (body, compress_variants(body))
+        cache.set(key, encoded, getattr(settings, 'CK_METABLOG_ARCHIVE_CACHE_TIMEOUT', 60 * 60 * 24))
+
+    body, variants = encoded
+    etag = 'archive-%s-%s-%d' % (archive_mode(), visitors, tree.version)
+    response = variant_response(request, body, variants, 'application/json', etag,
+                                tree.last_modified)
+    patch_vary_headers(response, ('Cookie',))
+    return response
+
+
 def except_404_view(request):
     """
     Standard 404 View
     """
-    categories, statuses_to_display, archives, blogroll = common(request.user.is_authenticated)
+    categories, statuses_to_display, archives, blogroll = common(request.user.is_authenticated())
 
     context = {
         'page_title': settings.CK_SITE_TITLE,
@@ -334,6 +348,7 @@ def except_404_view(request):
     return render_to_response("404.html", context, context_instance=RequestContext(request))
 
 
+@cached_page
 def article(request, post_slug):
     """
         Retrieves a single post (a single post view page)
@@ -343,9 +358,10 @@ def article(request, post_slug):
     if not post_slug:
         raise Http404
 
-    post = get_object_or_404(Post, slug=post_slug)
+    # neighbors come along for the prev/next links
+    post = get_object_or_404(Post.objects.select_related('prev_post', 'next_post'), slug=post_slug)
 
-    categories, statuses_to_display, archives, blogroll = common(request.user.is_authenticated)
+    categories, statuses_to_display, archives, blogroll = common(request.user.is_authenticated())
     if post.status not in statuses_to_display:
         raise Http404
 
@@ -353,6 +369,10 @@ def article(request, post_slug):
     if post:
         first_post_id = post.id
 
+    related = related_posts(post, statuses_to_display)
+    depends_on_posts(request, [post, post.prev_post, post.next_post] + related)
+    depends_on(request, RELATED_GENERATION)
+
     # render
     return render_to_response("post.html",
                                 {
@@ -360,6 +380,7 @@ def article(request, post_slug):
                                     'categories': categories,
                                     'selected_category': None,
                                     'blog_post': post,
+                                    'related_posts': related,
                                     'archives': archives,
                                     'blogroll': blogroll,
                                     'first_post_id': first_post_id
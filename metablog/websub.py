@@ -0,0 +1,82 @@
+"""@package docstring
+WebSub (PubSubHubbub) publishing.
+
+With CK_METABLOG_WEBSUB_HUB set, feeds advertise the hub in a rel="hub" link
+and publishing, editing or retagging a visible post queues a WebSub Ping for
+each feed it appears in: the latest-posts feeds and the feeds of its
+categories, in every format.  The pings of one publish event fall due
+together, after CK_METABLOG_WEBSUB_WINDOW seconds, and process_pings sends
+them to the hub as a single publish request.
+"""
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.db.models.signals import post_save, m2m_changed
+from django.utils import timezone
+
+from models import Post, Ping
+from taxonomy import all_categories
+from urlbuilder import site_url
+
+from datetime import timedelta
+
+
+FEED_NAMES = ('rss', 'atom', 'json')
+
+
+def hub_url():
+    return getattr(settings, 'CK_METABLOG_WEBSUB_HUB', None)
+
+
+def feed_urls(tag_ids):
+    """
+    Full URLs of the feeds showing a post with the given tags.
+    """
+    paths = [reverse('%s-latest' % name) for name in FEED_NAMES]
+    for category in all_categories():
+        if category.tag_id in tag_ids:
+            paths.extend(reverse('%s-category-latest' % name,
+                                 kwargs={'category_slug': category.tag.slug})
+                         for name in FEED_NAMES)
+
+    return [site_url(path) for path in paths]
+
+
+def queue_feed_updates(post, tag_ids):
+    """
+    Queues a WebSub Ping for each feed showing the post.  Feeds that already
+    have a pending ping are skipped; that ping will announce them.
+    """
+    hub = hub_url()
+    if not hub:
+        return []
+
+    pending = set(Ping.objects.filter(
+        kind=Ping.WEBSUB, endpoint=hub, status=Ping.PENDING
+    ).values_list('url', flat=True))
+
+    due_date = timezone.now() + timedelta(seconds=getattr(settings, 'CK_METABLOG_WEBSUB_WINDOW', 10))
+    pings = [Ping(kind=Ping.WEBSUB, endpoint=hub, url=url, post=post, due_date=due_date)
+             for url in feed_urls(set(tag_ids)) if url not in pending]
+    Ping.objects.bulk_create(pings)
+    return pings
+
+
+def post_saved(sender, instance, raw=False, **kwargs):
+    if raw or not hub_url():
+        return
+    visible = Post.visible_statuses(False)
+    if instance.status in visible or instance._original_status in visible:
+        queue_feed_updates(instance, instance.tags.values_list('id', flat=True))
+
+
+def post_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove') or reverse or not hub_url():
+        return
+    if instance.status in Post.visible_statuses(False):
+        queue_feed_updates(instance, pk_set)
+
+
+post_save.connect(post_saved, sender=Post, dispatch_uid='metablog.websub.post_saved')
+m2m_changed.connect(post_tags_changed, sender=Post.tags.through,
+                    dispatch_uid='metablog.websub.post_tags_changed')